@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import Upload, UploadSecret, UploadSegment
+from .models import Upload, UploadBlob, UploadSecret, UploadSegment
 
 
 class UploadSecretInline(admin.TabularInline):
@@ -15,5 +15,12 @@ class UploadSegmentInline(admin.TabularInline):
 
 @admin.register(Upload)
 class UploadAdmin(admin.ModelAdmin):
-    readonly_fields = ['file', 'digest', 'user', 'session', 'created_at']
+    readonly_fields = ['file', 'digest', 'digest_algorithm', 'blob', 'status', 'user', 'session', 'created_at']
+    list_filter = ['status']
     inlines = [UploadSecretInline, UploadSegmentInline]
+
+
+@admin.register(UploadBlob)
+class UploadBlobAdmin(admin.ModelAdmin):
+    readonly_fields = ['algorithm', 'digest', 'size', 'file', 'reference_count']
+    list_display = ['algorithm', 'digest', 'size', 'reference_count']
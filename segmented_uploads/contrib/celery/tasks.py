@@ -1,7 +1,7 @@
 import logging
 
 from celery import shared_task
-from redis.exceptions import LockError as RedisLockError
+from segmented_uploads.locks import LockError
 from segmented_uploads.models import Upload
 
 logger = logging.getLogger(__name__)
@@ -22,7 +22,7 @@ def materialize(self, pk, algorithm):
     if exception:
         if isinstance(exception, Upload.DoesNotExist):
             message = 'Task %s was unable to retrieve upload %s'
-        elif isinstance(exception, RedisLockError):
+        elif isinstance(exception, LockError):
             message = 'Task %s was unable to obtain lock for materialization of upload %s'
         else:
             message = 'Task %s encountered unhandled exception processing materialization of upload %s'
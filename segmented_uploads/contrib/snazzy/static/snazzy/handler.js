@@ -76,6 +76,44 @@
                 loadNext();
             }
             
+            function runLimited(tasks) {
+                // run a few tasks at a time so hashing holds only that many chunks
+                // in memory instead of reading the whole file at once
+                var pending = tasks.slice(),
+                    workers = [];
+                function next() {
+                    return pending.length ? pending.shift()().then(next) : Promise.resolve();
+                }
+                for (var i = 0; i < 4; i++) {
+                    workers.push(next());
+                }
+                return Promise.all(workers);
+            }
+            
+            function calculateTreeHash(file, cb) {
+                // hash every chunk and then their concatenated digests, which the
+                // server verifies from the segment digests it already stores
+                var digests = [];
+                runLimited($.map(file.chunks, function(chunk, i){
+                    return function(){
+                        return new Promise(function(resolve){
+                            if (chunk.md5sum) {
+                                digests[i] = chunk.md5sum;
+                                resolve();
+                                return;
+                            }
+                            calculateHash(file.file, function(digest){
+                                chunk.md5sum = digest;
+                                digests[i] = digest;
+                                resolve();
+                            }, chunk.startByte, chunk.endByte);
+                        });
+                    };
+                })).then(function(){
+                    cb(SparkMD5.hash(digests.join('')));
+                });
+            }
+            
             function getFileName(file) {
                 // necessary per https://github.com/23/resumable.js/blob/v1.1.0/resumable.js#L434
                 return file.fileName || file.name;
@@ -102,14 +140,36 @@
                 
                 function process(settings) {
                     var maxFileSize = settings.segment_limit * settings.segment_allowable_size;
+                    // opt in to sending segments as raw request bodies with
+                    // data-segmented-upload-raw to skip multipart parsing
+                    var raw = $el.is("[data-segmented-upload-raw]");
+                    // opt in to asking the server to reuse identical segments it
+                    // already received (e.g. from an earlier version of the file)
+                    // with data-segmented-upload-reuse
+                    var reuse = $el.is("[data-segmented-upload-reuse]");
+                    // opt in to verifying the complete file with a tree digest built
+                    // from the segment digests with data-segmented-upload-tree
+                    var tree = $el.is("[data-segmented-upload-tree]");
+                    var fileAlgorithm = tree ? 'tree-md5' : 'md5';
                     
                     var r = new Resumable({
-                        target: endpoint,
+                        // the algorithm is also passed in the query string so the
+                        // server can hash segments while they are being received
+                        target: endpoint + (endpoint.indexOf('?') < 0 ? '?' : '&') + 'algorithm=md5',
                         chunkSize: settings.segment_allowable_size,
                         forceChunkSize: true,
+                        // received chunks are skipped using the manifest instead
+                        testChunks: false,
+                        method: raw ? 'octet' : 'multipart',
+                        uploadMethod: raw ? 'PATCH' : 'POST',
                         permanentErrors: [400, 403, 409, 500],
                         withCredentials: true,
                         preprocess: function(chunk){
+                            if (chunk.md5sum) {
+                                // already hashed while probing for reuse
+                                chunk.preprocessFinished();
+                                return;
+                            }
                             calculateHash(chunk.fileObj.file, function(digest){
                                 chunk.md5sum = digest;
                                 chunk.preprocessFinished();
@@ -152,6 +212,7 @@
                         identifierParameterName: 'identifier',
                         fileNameParameterName: 'filename',
                         chunkNumberParameterName: 'index',
+                        chunkSizeParameterName: 'chunk_size',
                         totalChunksParameterName: 'count',
                         currentChunkSizeParameterName: 'segment_size',
                         totalSizeParameterName: 'total_size'
@@ -160,7 +221,15 @@
                     console.log('created resumable object');
                     console.log(r);
                     
-                    r.on('fileSuccess', function(file){
+                    function completed(secret){
+                        $el.val(secret);
+                        $progress.progressbar("value", false);
+                        progressIsSuccess();
+                        
+                        $form.off(namespaced_submit_event).submit();
+                    }
+                    
+                    function finalize(file){
                         // trigger materialization
                         var pollDelay = 3000;
                         $.ajax({
@@ -173,7 +242,7 @@
                                 csrfmiddlewaretoken: Cookies.get('csrftoken'),
                                 identifier: file.uniqueIdentifier,
                                 digest: file.md5sum,
-                                algorithm: 'md5'
+                                algorithm: fileAlgorithm
                             },
                             dataType: "text",
                             error: function(jqXHR){
@@ -200,11 +269,7 @@
                                     console.log("materialization success");
                                     console.log(secret);
                                     
-                                    $el.val(secret);
-                                    $progress.progressbar("value", false);
-                                    progressIsSuccess();
-                                    
-                                    $form.off(namespaced_submit_event).submit();
+                                    completed(secret);
                                 } else {
                                     console.log("materialization pending; continue polling " + opts.url + " in " + pollDelay +  " milliseconds.");
                                     $progress.progressbar("value", false);
@@ -214,7 +279,203 @@
                                 }
                             },
                         });
-                    });
+                    }
+                    
+                    r.on('fileSuccess', finalize);
+                    
+                    function skipChunk(chunk) {
+                        // mark the chunk as uploaded without sending it
+                        chunk.tested = true;
+                        chunk.preprocessState = 2;
+                        chunk.xhr = {readyState: 4, status: 200, responseText: ''};
+                    }
+                    
+                    function reuseChunk(file, chunk) {
+                        // the server copies an identical segment it already has
+                        // into this upload and answers with no content otherwise
+                        return new Promise(function(done){
+                            function probe(digest){
+                                chunk.md5sum = digest;
+                                $.ajax({
+                                    url: endpoint,
+                                    method: "POST",
+                                    xhrFields: {
+                                        withCredentials: true
+                                    },
+                                    data: {
+                                        csrfmiddlewaretoken: Cookies.get('csrftoken'),
+                                        identifier: file.uniqueIdentifier,
+                                        filename: getFileName(file),
+                                        index: chunk.offset + 1,
+                                        digest: digest,
+                                        algorithm: 'md5',
+                                        segment_size: chunk.endByte - chunk.startByte,
+                                        chunk_size: r.getOpt('chunkSize'),
+                                        total_size: file.size,
+                                        reuse: 1
+                                    },
+                                    dataType: "text",
+                                    error: function(){
+                                        done();
+                                    },
+                                    success: function(data, textStatus, jqXHR){
+                                        if (jqXHR.status == 200) {
+                                            skipChunk(chunk);
+                                        }
+                                        done();
+                                    }
+                                });
+                            }
+                            if (chunk.md5sum) {
+                                probe(chunk.md5sum);
+                            } else {
+                                calculateHash(file.file, probe, chunk.startByte, chunk.endByte);
+                            }
+                        });
+                    }
+                    
+                    function verifyChunk(file, chunk, expected) {
+                        // skip a received chunk unless its digest tells it apart
+                        return new Promise(function(done){
+                            function skip() {
+                                skipChunk(chunk);
+                                done();
+                            }
+                            if (!expected) {
+                                skip();
+                            } else {
+                                calculateHash(file.file, function(digest){
+                                    if (digest === expected) {
+                                        skip();
+                                    } else {
+                                        done();
+                                    }
+                                }, chunk.startByte, chunk.endByte);
+                            }
+                        });
+                    }
+                    
+                    function skipReceivedChunks(file) {
+                        // ask for every segment the server already has in one request
+                        // instead of testing each chunk individually
+                        return new Promise(function(resolve){
+                            $.ajax({
+                                url: endpoint,
+                                method: "GET",
+                                xhrFields: {
+                                    withCredentials: true
+                                },
+                                data: {
+                                    identifier: file.uniqueIdentifier,
+                                    manifest: 1
+                                },
+                                dataType: "json",
+                                error: function(){
+                                    console.log('failed to get manifest');
+                                    resolve();
+                                },
+                                success: function(manifest){
+                                    var received = {},
+                                        checks = [];
+                                    if (manifest.materialized) {
+                                        // nothing is left to send, finalizing answers
+                                        // with the secret right away
+                                        $.each(file.chunks, function(i, chunk){
+                                            skipChunk(chunk);
+                                        });
+                                        resolve();
+                                        return;
+                                    }
+                                    $.each(manifest.received, function(i, range){
+                                        for (var index = range[0]; index <= range[1]; index++) {
+                                            received[index] = true;
+                                        }
+                                    });
+                                    $.each(file.chunks, function(i, chunk){
+                                        var index = chunk.offset + 1;
+                                        if (!received[index]) {
+                                            if (reuse) {
+                                                checks.push(function(){
+                                                    return reuseChunk(file, chunk);
+                                                });
+                                            }
+                                            return;
+                                        }
+                                        checks.push(function(){
+                                            return verifyChunk(file, chunk, (manifest.digests[index] || {}).md5);
+                                        });
+                                    });
+                                    runLimited(checks).then(resolve);
+                                }
+                            });
+                        });
+                    }
+                    
+                    function finishInstantly(file) {
+                        // the server may already have an identical file for us, in
+                        // which case it answers with a secret and nothing is sent
+                        return new Promise(function(resolve){
+                            $.ajax({
+                                url: endpoint,
+                                method: "POST",
+                                xhrFields: {
+                                    withCredentials: true
+                                },
+                                data: {
+                                    csrfmiddlewaretoken: Cookies.get('csrftoken'),
+                                    identifier: file.uniqueIdentifier,
+                                    filename: getFileName(file),
+                                    digest: file.md5sum,
+                                    algorithm: fileAlgorithm,
+                                    total_size: file.size,
+                                    instant: 1
+                                },
+                                dataType: "text",
+                                error: function(){
+                                    console.log('failed to finish upload instantly');
+                                    resolve('');
+                                },
+                                success: function(secret){
+                                    resolve(secret);
+                                }
+                            });
+                        });
+                    }
+                    
+                    function startUpload() {
+                        // only servers sharing identical files can finish instantly
+                        if (!settings.deduplicate) {
+                            sendSegments();
+                            return;
+                        }
+                        Promise.all($.map(r.files, finishInstantly)).then(function(secrets){
+                            var missing = $.grep(secrets, function(secret){
+                                return !secret;
+                            });
+                            if (secrets.length && !missing.length) {
+                                console.log("upload finished instantly");
+                                completed(secrets[0]);
+                            } else {
+                                sendSegments();
+                            }
+                        });
+                    }
+                    
+                    function sendSegments() {
+                        Promise.all($.map(r.files, skipReceivedChunks)).then(function(){
+                            var pending = $.grep(r.files, function(f){
+                                return !f.isComplete();
+                            });
+                            if (pending.length) {
+                                r.upload();
+                            } else {
+                                // every segment was already received
+                                $.each(r.files, function(i, f){
+                                    finalize(f);
+                                });
+                            }
+                        });
+                    }
                     
                     var $form = $el.parentsUntil("form").parent();
                     var required = $el.prop("required");
@@ -252,9 +513,15 @@
                         if (handleFileAddedValidation(file)) {
                             // calculate the whole file hash here and we will wait for it
                             // to become available before finalizing the upload
-                            calculateHash(file.file, function(md5sum){
-                                file.md5sum = md5sum;
-                            });
+                            if (tree) {
+                                calculateTreeHash(file, function(md5sum){
+                                    file.md5sum = md5sum;
+                                });
+                            } else {
+                                calculateHash(file.file, function(md5sum){
+                                    file.md5sum = md5sum;
+                                });
+                            }
                         }
                         console.log('file #' + r.files.length + ' added');
                         console.log(file);
@@ -394,7 +661,7 @@
                                     var interval = setInterval(function(){
                                         if (filesAreHashed()) {
                                             clearInterval(interval);
-                                            r.upload();
+                                            startUpload();
                                         } else {
                                             console.log('waiting on file digest to start upload');
                                         }
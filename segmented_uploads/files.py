@@ -0,0 +1,307 @@
+import bisect
+import errno
+import fnmatch
+import io
+import itertools
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# errors raised by the kernel copy primitives when they cannot handle a given
+# pair of file descriptors (e.g. crossing filesystems) and we should fall back
+FALLBACK_ERRNOS = frozenset(
+    getattr(errno, name) for name in ('EXDEV', 'ENOSYS', 'EINVAL', 'EOPNOTSUPP', 'ENOTSUP', 'EBADF', 'EPERM')
+    if hasattr(errno, name)
+)
+
+
+def is_local_storage(storage):
+    return isinstance(storage, FileSystemStorage)
+
+
+def _copy_file_range(src_fd, dst_fd, count):
+    return os.copy_file_range(src_fd, dst_fd, count)
+
+
+def _sendfile(src_fd, dst_fd, count):
+    return os.sendfile(dst_fd, src_fd, None, count)
+
+
+def _kernel_copiers():
+    if hasattr(os, 'copy_file_range'):
+        yield _copy_file_range
+    if hasattr(os, 'sendfile'):
+        yield _sendfile
+
+
+def _userspace_copy(src_fd, dst_fd, count):
+    data = os.read(src_fd, min(count, COPY_CHUNK_SIZE))
+    write_all(dst_fd, data)
+    return len(data)
+
+
+def append_file(src_path, dst_fd):
+    # copy_file_range lets the filesystem reflink the bytes, sendfile avoids the userspace copy
+    with open(src_path, 'rb', buffering=0) as src:
+        append_open_file(src, dst_fd)
+
+
+def append_open_file(src, dst_fd):
+    src_fd = src.fileno()
+    remaining = os.fstat(src_fd).st_size
+    copiers = list(_kernel_copiers()) + [_userspace_copy]
+    for copy in copiers:
+        try:
+            while remaining:
+                copied = copy(src_fd, dst_fd, remaining)
+                if not copied:
+                    break
+                remaining -= copied
+        except OSError as e:
+            if copy is _userspace_copy or e.errno not in FALLBACK_ERRNOS:
+                raise
+        else:
+            break
+    if remaining:
+        raise IOError('unexpected end of file while copying %s' % src.name)
+
+
+def write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def pwrite_all(fd, data, offset):
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+    return offset
+
+
+def delete_files(storage, names, workers=0):
+    if workers:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(storage.delete, names))
+    else:
+        for name in names:
+            storage.delete(name)
+
+
+def remove_stale_files(path, pattern, max_age, recursive=False):
+    cutoff = time.time() - max_age
+    for root, dirs, names in os.walk(path):
+        for name in fnmatch.filter(names, pattern):
+            path = os.path.join(root, name)
+            try:
+                stat = os.lstat(path)
+                # linking a file only updates its ctime
+                if max(stat.st_mtime, stat.st_ctime) < cutoff:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+        if not recursive:
+            break
+
+
+def read_segment_chunks(segment):
+    with segment.file.open() as f:
+        yield from f.chunks()
+
+
+def append_segment(segment, dst_fd, src=None):
+    if src is not None:
+        append_open_file(src, dst_fd)
+    elif is_local_storage(segment.file.storage):
+        append_file(segment.file.path, dst_fd)
+    else:
+        for chunk in read_segment_chunks(segment):
+            write_all(dst_fd, chunk)
+
+
+class SegmentPrefetch(object):
+    done = object()
+    
+    def __init__(self, segment, max_chunks, cancelled):
+        self.segment = segment
+        self.queue = queue.Queue(max_chunks)
+        self.cancelled = cancelled
+    
+    def put(self, item):
+        while not self.cancelled.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+            except queue.Full:
+                continue
+            return True
+        return False
+    
+    def run(self):
+        try:
+            for chunk in read_segment_chunks(self.segment):
+                if not self.put(chunk):
+                    return
+        except Exception as e:
+            self.put(e)
+        else:
+            self.put(self.done)
+    
+    def chunks(self):
+        while True:
+            item = self.queue.get()
+            if item is self.done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+
+def prefetch_segment_chunks(segments, count, buffer_size):
+    max_chunks = max(1, buffer_size // ((count + 1) * File.DEFAULT_CHUNK_SIZE))
+    cancelled = threading.Event()
+    pending = deque()
+    segments = iter(segments)
+    with ThreadPoolExecutor(max_workers=count + 1) as executor:
+        try:
+            def fill():
+                for segment in segments:
+                    prefetch = SegmentPrefetch(segment, max_chunks, cancelled)
+                    executor.submit(prefetch.run)
+                    pending.append(prefetch)
+                    if count < len(pending):
+                        break
+            fill()
+            while pending:
+                prefetch = pending.popleft()
+                fill()
+                yield prefetch.segment, prefetch.chunks()
+        finally:
+            cancelled.set()
+
+
+def open_local_segment(segment):
+    src = open(segment.file.path, 'rb', buffering=0)
+    if hasattr(os, 'posix_fadvise'):
+        # start fetching it from network filesystems while earlier segments are copied
+        os.posix_fadvise(src.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+    return src
+
+
+def prefetch_segment_files(segments, count):
+    pending = deque()
+    segments = iter(segments)
+    with ThreadPoolExecutor(max_workers=count) as executor:
+        try:
+            while True:
+                for segment in itertools.islice(segments, count + 1 - len(pending)):
+                    opened = executor.submit(open_local_segment, segment) if is_local_storage(segment.file.storage) else None
+                    pending.append((segment, opened))
+                if not pending:
+                    return
+                segment, opened = pending.popleft()
+                src = opened and opened.result()
+                try:
+                    yield segment, src
+                finally:
+                    if src:
+                        src.close()
+        finally:
+            for segment, opened in pending:
+                if opened:
+                    opened.add_done_callback(lambda opened: opened.exception() or opened.result().close())
+
+
+def segment_files(segments, prefetch=0):
+    if prefetch:
+        yield from prefetch_segment_files(segments, prefetch)
+    else:
+        for segment in segments:
+            yield segment, None
+
+
+def segment_chunks(segments, prefetch=0, buffer_size=0):
+    if prefetch:
+        yield from prefetch_segment_chunks(segments, prefetch, buffer_size)
+    else:
+        for segment in segments:
+            yield segment, read_segment_chunks(segment)
+
+
+class SegmentsFile(io.RawIOBase):
+    # parts are (open, offset, size) tuples and only the one being read is kept open
+    def __init__(self, parts):
+        self.parts = list(parts)
+        self.starts = list(itertools.accumulate([0] + [size for open_part, offset, size in self.parts]))
+        self.size = self.starts[-1]
+        self.position = 0
+        self.current = None
+        self.current_index = None
+    
+    def readable(self):
+        return True
+    
+    def seekable(self):
+        return True
+    
+    def tell(self):
+        return self.position
+    
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError('invalid whence (%r)' % whence)
+        if position < 0:
+            raise ValueError('negative seek position %d' % position)
+        self.position = position
+        return position
+    
+    def open_part(self, index):
+        if self.current_index != index:
+            self.close_part()
+            self.current = self.parts[index][0]()
+            self.current_index = index
+        return self.current
+    
+    def close_part(self):
+        if self.current is not None:
+            self.current.close()
+        self.current = self.current_index = None
+    
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast('B')
+        count = 0
+        while count < len(view) and self.position < self.size:
+            # empty parts share their start with the next one, so bisecting to
+            # the right skips them
+            index = bisect.bisect_right(self.starts, self.position) - 1
+            open_part, offset, size = self.parts[index]
+            within = self.position - self.starts[index]
+            f = self.open_part(index)
+            f.seek(offset + within)
+            data = f.read(min(len(view) - count, size - within))
+            if not data:
+                raise IOError('unexpected end of file in segment %d' % index)
+            view[count:count + len(data)] = data
+            count += len(data)
+            self.position += len(data)
+        return count
+    
+    def close(self):
+        self.close_part()
+        super().close()
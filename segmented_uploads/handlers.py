@@ -0,0 +1,70 @@
+import os
+import tempfile
+
+from django.conf import settings
+from django.core.files.uploadedfile import TemporaryUploadedFile, UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, TemporaryFileUploadHandler
+
+from .files import is_local_storage
+from .models import UploadSegment, get_hashers, get_hexdigests
+
+
+def get_segment_temp_dir():
+    storage = UploadSegment._meta.get_field('file').storage
+    if is_local_storage(storage):
+        # keep temporary files on the same filesystem as the segments so saving
+        # them to storage is a rename rather than a copy
+        path = storage.path(UploadSegment.upload_to_prefix)
+        os.makedirs(path, exist_ok=True)
+        return path
+    return settings.FILE_UPLOAD_TEMP_DIR
+
+
+class SegmentTemporaryUploadedFile(TemporaryUploadedFile):
+    def __init__(self, name, content_type, size, charset, content_type_extra=None, dir=None):
+        _, ext = os.path.splitext(name)
+        # Upload.purge removes these by name when they are left behind
+        file = tempfile.NamedTemporaryFile(prefix='tmp', suffix='.upload' + ext, dir=dir)
+        UploadedFile.__init__(self, file, name, content_type, size, charset, content_type_extra)
+        self.digests = {}
+
+
+class SegmentUploadHandler(TemporaryFileUploadHandler):
+    # hashing while streaming means the segment never has to be read again
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.algorithm = request.GET.get('algorithm', '') if request is not None else ''
+    
+    def new_file(self, *args, **kwargs):
+        FileUploadHandler.new_file(self, *args, **kwargs)
+        self.hasher = get_hashers(self.algorithm)
+        self.file = SegmentTemporaryUploadedFile(
+            self.file_name,
+            self.content_type,
+            0,
+            self.charset,
+            self.content_type_extra,
+            dir=get_segment_temp_dir(),
+        )
+    
+    def receive_data_chunk(self, raw_data, start):
+        self.file.write(raw_data)
+        self.hasher.update(raw_data)
+    
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        file.digests.update(get_hexdigests(self.hasher, self.algorithm))
+        return file
+
+
+def receive_raw_segment(request):
+    handler = SegmentUploadHandler(request)
+    handler.new_file('file', request.GET.get('filename', ''), request.content_type, request.META.get('CONTENT_LENGTH'))
+    received = 0
+    while True:
+        chunk = request.read(handler.chunk_size)
+        if not chunk:
+            break
+        handler.receive_data_chunk(chunk, received)
+        received += len(chunk)
+    return handler.file_complete(received)
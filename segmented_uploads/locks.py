@@ -0,0 +1,163 @@
+import os
+import threading
+from hashlib import sha1
+from tempfile import gettempdir
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.utils.module_loading import import_string
+
+try:
+    from redis.exceptions import LockError as BaseLockError
+except ImportError:
+    BaseLockError = Exception
+
+
+class LockError(BaseLockError):
+    # subclasses the redis LockError when installed so existing handlers keep working
+    pass
+
+
+class BaseLock(object):
+    def __init__(self, name, timeout):
+        self.name = name
+        self.timeout = timeout
+    
+    def acquire(self):
+        raise NotImplementedError
+    
+    def release(self):
+        raise NotImplementedError
+    
+    def extend(self, additional_time):
+        self.reacquire()
+    
+    def reacquire(self):
+        raise NotImplementedError
+    
+    def __enter__(self):
+        if not self.acquire():
+            raise LockError('Unable to acquire lock %s' % self.name)
+        return self
+    
+    def __exit__(self, *args):
+        self.release()
+
+
+class RedisLock(BaseLock):
+    def __init__(self, name, timeout):
+        super().__init__(name, timeout)
+        cache = caches[getattr(settings, 'UPLOADS_CACHE_LOCK_REDIS_NAME', 'default')]
+        # locks are renewed from other threads, so the token can't be thread local
+        self.lock = cache.lock(name, timeout=timeout, blocking_timeout=-1, thread_local=False)
+    
+    def call(self, method, *args):
+        try:
+            return getattr(self.lock, method)(*args)
+        except LockError:
+            raise
+        except BaseLockError as e:
+            raise LockError(str(e)) from e
+    
+    def acquire(self):
+        return self.call('acquire', False)
+    
+    def release(self):
+        self.call('release')
+    
+    def extend(self, additional_time):
+        self.call('extend', additional_time)
+    
+    def reacquire(self):
+        self.call('reacquire')
+
+
+class PostgresAdvisoryLock(BaseLock):
+    # PostgreSQL frees it as soon as the connection of a dead holder goes away.
+    # advisory locks are reentrant per session, so track the ones held by this
+    # process to keep them exclusive between threads sharing a connection
+    held = set()
+    held_guard = threading.Lock()
+    
+    def __init__(self, name, timeout):
+        super().__init__(name, timeout)
+        self.using = getattr(settings, 'UPLOADS_LOCK_DATABASE', DEFAULT_DB_ALIAS)
+        self.key = int.from_bytes(sha1(name.encode()).digest()[:8], 'big') >> 1
+        self.pid = None
+    
+    def acquire(self):
+        with self.held_guard:
+            if self.key in self.held:
+                return False
+            with connections[self.using].cursor() as cursor:
+                cursor.execute('SELECT pg_try_advisory_lock(%s), pg_backend_pid()', [self.key])
+                acquired, pid = cursor.fetchone()
+            if acquired:
+                self.held.add(self.key)
+                self.pid = pid
+            return acquired
+    
+    def release(self):
+        with self.held_guard:
+            self.held.discard(self.key)
+            self.pid = None
+            with connections[self.using].cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_unlock(%s)', [self.key])
+                released = cursor.fetchone()[0]
+        if not released:
+            raise LockError('Cannot release lock %s that is not held' % self.name)
+    
+    def reacquire(self):
+        # this may run on another thread, and so another connection, than the
+        # one holding the lock
+        if self.pid is not None:
+            with connections[self.using].cursor() as cursor:
+                cursor.execute(
+                    "SELECT 1 FROM pg_locks WHERE locktype = 'advisory' AND granted AND pid = %s "
+                    "AND classid::bigint = %s AND objid::bigint = %s AND objsubid = 1",
+                    [self.pid, self.key >> 32, self.key & 0xffffffff],
+                )
+                if cursor.fetchone():
+                    return
+        raise LockError('Lock %s is not held' % self.name)
+
+
+class FileLock(BaseLock):
+    # the kernel frees it as soon as a dead holder's process goes away
+    def __init__(self, name, timeout):
+        super().__init__(name, timeout)
+        directory = getattr(settings, 'UPLOADS_LOCK_DIR', None) or os.path.join(gettempdir(), 'segmented_uploads-locks')
+        self.path = os.path.join(directory, '{}.lock'.format(sha1(name.encode()).hexdigest()))
+        self.fp = None
+    
+    def acquire(self):
+        import fcntl
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fp = open(self.path, 'ab')
+        try:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            fp.close()
+            return False
+        except BaseException:
+            fp.close()
+            raise
+        self.fp = fp
+        return True
+    
+    def release(self):
+        if self.fp is None:
+            raise LockError('Cannot release lock %s that is not held' % self.name)
+        # closing the file releases the lock
+        self.fp.close()
+        self.fp = None
+    
+    def reacquire(self):
+        if self.fp is None:
+            raise LockError('Lock %s is not held' % self.name)
+
+
+def get_lock(name, timeout):
+    backend = import_string(getattr(settings, 'UPLOADS_LOCK_BACKEND', 'segmented_uploads.locks.RedisLock'))
+    return backend(name, timeout)
@@ -0,0 +1,39 @@
+# Generated by Django 3.0.14 on 2026-10-16 20:56
+
+from django.db import migrations, models
+import segmented_uploads.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('segmented_uploads', '0002_upload_lingering'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='upload',
+            name='assembled_index',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='upload',
+            name='assembled_size',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='upload',
+            name='partial',
+            field=models.FileField(blank=True, editable=False, upload_to=segmented_uploads.models.instance_upload_to),
+        ),
+        migrations.AddField(
+            model_name='uploadsegment',
+            name='offset',
+            field=models.BigIntegerField(default=None, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='uploadsegment',
+            name='size',
+            field=models.BigIntegerField(default=None, editable=False, null=True),
+        ),
+    ]
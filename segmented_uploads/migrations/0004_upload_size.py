@@ -0,0 +1,29 @@
+# Generated by Django 3.0.14 on 2026-10-16 20:58
+
+from django.db import migrations, models
+import segmented_uploads.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('segmented_uploads', '0003_upload_partial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='upload',
+            name='chunk_size',
+            field=models.BigIntegerField(default=None, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='upload',
+            name='size',
+            field=models.BigIntegerField(default=None, editable=False, null=True),
+        ),
+        migrations.AlterField(
+            model_name='uploadsegment',
+            name='file',
+            field=models.FileField(blank=True, upload_to=segmented_uploads.models.instance_upload_to),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.0.14 on 2026-10-16 21:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('segmented_uploads', '0004_upload_size'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadsegment',
+            name='digest',
+            field=models.CharField(blank=True, editable=False, max_length=40),
+        ),
+        migrations.AddField(
+            model_name='uploadsegment',
+            name='digest_algorithm',
+            field=models.CharField(blank=True, editable=False, max_length=32),
+        ),
+    ]
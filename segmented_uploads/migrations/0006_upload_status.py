@@ -0,0 +1,24 @@
+# Generated by Django 3.0.14 on 2026-10-16 21:10
+
+from django.db import migrations, models
+
+
+def mark_materialized_ready(apps, schema_editor):
+    Upload = apps.get_model('segmented_uploads', 'Upload')
+    Upload.objects.exclude(file='').update(status='ready')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('segmented_uploads', '0005_uploadsegment_digest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='upload',
+            name='status',
+            field=models.CharField(choices=[('receiving', 'Receiving'), ('materializing', 'Materializing'), ('ready', 'Ready'), ('failed', 'Failed')], db_index=True, default='receiving', editable=False, max_length=16),
+        ),
+        migrations.RunPython(mark_materialized_ready, migrations.RunPython.noop),
+    ]
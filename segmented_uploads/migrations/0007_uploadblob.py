@@ -0,0 +1,40 @@
+# Generated by Django 3.0.14 on 2026-10-16 22:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+import segmented_uploads.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('segmented_uploads', '0006_upload_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadBlob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('algorithm', models.CharField(max_length=32)),
+                ('digest', models.CharField(max_length=40)),
+                ('size', models.BigIntegerField()),
+                ('file', models.FileField(upload_to=segmented_uploads.models.instance_upload_to)),
+                ('reference_count', models.IntegerField(default=0)),
+            ],
+            options={
+                'unique_together': {('algorithm', 'digest', 'size')},
+            },
+            bases=(segmented_uploads.models.UploadToMixin, models.Model),
+        ),
+        migrations.AddField(
+            model_name='upload',
+            name='digest_algorithm',
+            field=models.CharField(blank=True, editable=False, max_length=32),
+        ),
+        migrations.AddField(
+            model_name='upload',
+            name='blob',
+            field=models.ForeignKey(default=None, editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='uploads', to='segmented_uploads.UploadBlob'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.0.14 on 2026-10-16 22:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('segmented_uploads', '0007_uploadblob'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='uploadsegment',
+            index=models.Index(fields=['digest', 'digest_algorithm'], name='segment_digest_idx'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.0.14 on 2026-10-16 23:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('segmented_uploads', '0008_segment_digest_idx'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='upload',
+            name='digest',
+            field=models.CharField(blank=True, editable=False, max_length=128),
+        ),
+        migrations.AlterField(
+            model_name='uploadblob',
+            name='digest',
+            field=models.CharField(max_length=128),
+        ),
+        migrations.AlterField(
+            model_name='uploadsegment',
+            name='digest',
+            field=models.CharField(blank=True, editable=False, max_length=128),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.0.14 on 2026-10-16 23:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('segmented_uploads', '0009_digest_max_length'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='upload',
+            name='digests',
+            field=models.TextField(blank=True, editable=False),
+        ),
+        migrations.AddField(
+            model_name='uploadsegment',
+            name='digests',
+            field=models.TextField(blank=True, editable=False),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 3.0.14 on 2026-10-16 23:55
+
+from django.db import migrations, models
+
+
+def mark_lazily_materialized(apps, schema_editor):
+    Upload = apps.get_model('segmented_uploads', 'Upload')
+    Upload.objects.filter(status='ready', file='').update(lazy=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('segmented_uploads', '0010_digests'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='upload',
+            name='lazy',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.RunPython(mark_lazily_materialized, migrations.RunPython.noop),
+    ]
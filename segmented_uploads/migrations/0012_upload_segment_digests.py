@@ -0,0 +1,18 @@
+# Generated by Django 3.0.14 on 2026-10-17 00:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('segmented_uploads', '0011_upload_lazy'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='upload',
+            name='segment_digests',
+            field=models.TextField(blank=True, editable=False),
+        ),
+    ]
@@ -1,21 +1,28 @@
+import json
+import os
 import secrets
 import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 from datetime import timedelta
-from hashlib import md5, sha1
-from tempfile import TemporaryFile, gettempdir
+from hashlib import blake2b, md5, sha1, sha256, sha512
+from tempfile import NamedTemporaryFile, TemporaryFile, gettempdir
 
 from django.conf import settings
 from django.core.exceptions import SuspiciousOperation, ValidationError
 from django.core.files import File
-from django.core.files.uploadedfile import TemporaryUploadedFile
-from django.db import models, transaction
+from django.core.files.uploadedfile import TemporaryUploadedFile, UploadedFile
+from django.db import IntegrityError, connections, models, router, transaction
 from django.db.models.signals import post_delete
 from django.dispatch.dispatcher import receiver
 from django.utils import timezone
 from django.utils.encoding import force_bytes
+from django.utils.module_loading import import_string
 
+from .files import SegmentsFile, append_segment, delete_files, is_local_storage, pwrite_all, remove_stale_files, segment_chunks, segment_files
 from .signals import trigger_materialization
-from .utils import cache_redis
+from .utils import hold_lock
 from .validators import validate_truthy_or_null
 
 
@@ -24,6 +31,14 @@ noop = lambda *args, **kwargs: None
 noop_str = lambda *args, **kwargs: ''
 
 
+def supports_returning(connection):
+    if connection.vendor == 'postgresql':
+        return True
+    if connection.vendor == 'sqlite':
+        return (3, 35) <= connection.Database.sqlite_version_info
+    return False
+
+
 class NoopHasher(object):
     update = noop
     hexdigest = noop_str
@@ -34,20 +49,169 @@ class NoopHasher(object):
 
 noop_hasher = NoopHasher()
 
+
+class PrecomputedHasher(NoopHasher):
+    def __init__(self, digest, digests=None):
+        self.digest = digest
+        self.digests = digests or {}
+    
+    def hexdigest(self):
+        return self.digest
+    
+    def hexdigests(self):
+        return self.digests
+
+
+class MultiHasher(object):
+    def __init__(self, hashers, algorithm):
+        self.hashers = hashers
+        self.algorithm = algorithm
+    
+    def update(self, data):
+        for hasher in self.hashers.values():
+            hasher.update(data)
+    
+    def hexdigest(self):
+        return self.hashers[self.algorithm].hexdigest()
+    
+    def hexdigests(self):
+        digests = {}
+        for algorithm, hasher in self.hashers.items():
+            digest = hasher.hexdigest()
+            if digest:
+                digests[algorithm] = digest
+        return digests
+
+class BackgroundHasher(object):
+    # hashlib releases the GIL on large chunks, so hashing overlaps with writing them out
+    def __init__(self, hasher, buffers):
+        self.hasher = hasher
+        self.buffers = buffers
+        self.pending = deque()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+    
+    def update(self, data):
+        # a single worker hashes the chunks in the order they were given
+        self.pending.append(self.executor.submit(self.hasher.update, data))
+        while self.buffers < len(self.pending):
+            self.pending.popleft().result()
+    
+    def flush(self):
+        while self.pending:
+            self.pending.popleft().result()
+        self.executor.shutdown()
+    
+    def hexdigest(self):
+        self.flush()
+        return self.hasher.hexdigest()
+
+
+def hash_in_background(hasher, buffers=None):
+    if buffers is None:
+        buffers = getattr(settings, 'UPLOADS_HASH_BUFFERS', 0)
+    if not buffers or isinstance(hasher, NoopHasher):
+        return hasher
+    if isinstance(hasher, MultiHasher):
+        return MultiHasher({
+            algorithm: hash_in_background(h, buffers)
+            for algorithm, h in hasher.hashers.items()
+        }, hasher.algorithm)
+    return BackgroundHasher(hasher, buffers)
+
+
+# wide enough for the hexdigest of sha512 and blake2b
+DIGEST_MAX_LENGTH = 128
+
 hasher_map = {
     'md5': md5,
     'sha1': sha1,
+    'sha256': sha256,
+    'sha512': sha512,
+    'blake2b': blake2b,
 }
 
 
+def register_hasher(algorithm, factory):
+    hasher_map[algorithm] = factory
+
+
+for name, factory in getattr(settings, 'UPLOADS_HASHERS', {}).items():
+    register_hasher(name, import_string(factory) if isinstance(factory, str) else factory)
+
+
+TREE_ALGORITHM_PREFIX = 'tree-'
+
+# shared files are looked up by a digest the server computes itself, so it has
+# to be collision resistant whatever algorithm clients ask for
+DEDUPLICATE_ALGORITHM = 'sha256'
+
+
 def get_hasher(algorithm, data=''):
     return hasher_map.get(algorithm, noop_hasher)(force_bytes(data))
 
 
+def get_hashers(algorithm, hasher=None):
+    if hasher is None:
+        hasher = get_hasher(algorithm)
+    hashers = {
+        name: get_hasher(name)
+        for name in getattr(settings, 'UPLOADS_DIGEST_ALGORITHMS', [])
+        if name in hasher_map and name != algorithm
+    }
+    if not hashers:
+        return hasher
+    hashers[algorithm] = hasher
+    return MultiHasher(hashers, algorithm)
+
+
+def get_hexdigests(hasher, algorithm):
+    digests = dict(hasher.hexdigests()) if hasattr(hasher, 'hexdigests') else {}
+    digest = hasher.hexdigest()
+    if digest:
+        digests.setdefault(algorithm, digest)
+    return digests
+
+
+def get_tree_base_algorithm(algorithm):
+    # a tree digest hashes the concatenated segment hexdigests, so they are enough to compute it
+    if algorithm.startswith(TREE_ALGORITHM_PREFIX):
+        base = algorithm[len(TREE_ALGORITHM_PREFIX):]
+        if base in hasher_map:
+            return base
+    return ''
+
+
+def is_supported_algorithm(algorithm):
+    return algorithm in hasher_map or bool(get_tree_base_algorithm(algorithm))
+
+
+def get_supported_algorithms():
+    return sorted(hasher_map) + sorted(TREE_ALGORITHM_PREFIX + algorithm for algorithm in hasher_map)
+
+
+def get_uploaded_file_hasher(uploaded_file, algorithm):
+    # upload handlers may have hashed the file while it was being received
+    digests = getattr(uploaded_file, 'digests', {})
+    if digests and (digests.get(algorithm) or not algorithm):
+        return PrecomputedHasher(digests.get(algorithm, ''), digests=digests)
+    return get_hashers(algorithm)
+
+
 def instance_upload_to(instance, filename):
     return instance.get_file_upload_to(filename)
 
 
+class DigestsMixin(object):
+    def get_digests(self):
+        digests = json.loads(self.digests) if self.digests else {}
+        if self.digest:
+            digests.setdefault(self.digest_algorithm, self.digest)
+        return digests
+    
+    def set_digests(self, digests):
+        self.digests = json.dumps(digests, sort_keys=True) if digests else ''
+
+
 class UploadToMixin(object):
     upload_to_prefix = ''
     
@@ -58,31 +222,112 @@ class UploadToMixin(object):
 UploadToMixin.upload_to = instance_upload_to
 
 
+class HeldByMixin(object):
+    # lookup from the model to the uploads holding it
+    held_by_prefix = ''
+    
+    @classmethod
+    def held_by(cls, user=None, session=None, **lookups):
+        if user is not None:
+            lookups[cls.held_by_prefix + 'user'] = user
+        else:
+            lookups[cls.held_by_prefix + 'session'] = session
+        return cls.objects.filter(**lookups)
+
+
 def set_error_for_field(errors, fields, error):
     for field in fields:
         errors.setdefault(field, []).append(error)
 
 
 class BoundUploadedFile(TemporaryUploadedFile):
+    # reading through a hard link keeps the content around after the upload is deleted
     def __init__(self, upload):
         if not upload.file:
             raise ValueError('not materialized')
-        super().__init__(
+        self.upload = upload
+        self.link_path = None
+        if is_local_storage(upload.file.storage):
+            path = upload.file.path
+            link_path = '{}.{}.handoff'.format(path, uuid.uuid4())
+            try:
+                os.link(path, link_path)
+            except OSError:
+                # e.g. the filesystem has no hard links
+                pass
+            else:
+                self.link_path = link_path
+        if self.link_path is not None:
+            file = open(self.link_path, 'rb')
+        else:
+            file = NamedTemporaryFile(suffix='.upload', dir=TEMP_DIR)
+            with upload.file.storage.open(upload.file.name) as f:
+                for chunk in f.chunks():
+                    file.write(chunk)
+            file.seek(0)
+        UploadedFile.__init__(
+            self,
+            file=file,
             name=upload.filename or upload.token,
             content_type='application/octet-stream',
             size=upload.file.size,
             charset=None,
         )
+    
+    def temporary_file_path(self):
+        if self.link_path is not None:
+            return self.link_path
+        return self.file.name
+    
+    def close(self):
+        try:
+            return self.file.close()
+        finally:
+            if self.link_path is not None:
+                try:
+                    os.remove(self.link_path)
+                except FileNotFoundError:
+                    # it was moved into place
+                    pass
+                self.link_path = None
+
+
+class SegmentedUploadedFile(UploadedFile):
+    def __init__(self, upload):
+        file = SegmentsFile(upload.get_segment_parts())
+        super().__init__(
+            file=file,
+            name=upload.filename or upload.token,
+            content_type='application/octet-stream',
+            size=file.size,
+            charset=None,
+        )
         self.upload = upload
-        with upload.file.storage.open(upload.file.name) as f:
-            for chunk in f.chunks():
-                self.file.write(chunk)
-        self.file.seek(0)
+        self.close_callbacks = []
+    
+    def close(self):
+        try:
+            return super().close()
+        finally:
+            callbacks, self.close_callbacks = self.close_callbacks, []
+            for callback in callbacks:
+                callback()
 
 
-class Upload(UploadToMixin, models.Model):
+class Upload(DigestsMixin, HeldByMixin, UploadToMixin, models.Model):
     upload_to_prefix = 'uploads/'
     
+    STATUS_RECEIVING = 'receiving'
+    STATUS_MATERIALIZING = 'materializing'
+    STATUS_READY = 'ready'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_RECEIVING, 'Receiving'),
+        (STATUS_MATERIALIZING, 'Materializing'),
+        (STATUS_READY, 'Ready'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+    
     class Meta:
         unique_together = [
             ["token", "session"],
@@ -94,14 +339,28 @@ class Upload(UploadToMixin, models.Model):
     session = models.CharField(max_length=255, db_index=True, null=True, default=None, editable=False)
     filename = models.CharField(max_length=255, blank=True)
     file = models.FileField(upload_to=UploadToMixin.upload_to, blank=True, editable=False)
-    digest = models.CharField(max_length=40, blank=True, editable=False)
+    digest = models.CharField(max_length=DIGEST_MAX_LENGTH, blank=True, editable=False)
+    digest_algorithm = models.CharField(max_length=32, blank=True, editable=False)
+    digests = models.TextField(blank=True, editable=False)
+    blob = models.ForeignKey('UploadBlob', related_name='uploads', on_delete=models.PROTECT, null=True, default=None, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     lingering = models.BooleanField(default=False)
+    partial = models.FileField(upload_to=UploadToMixin.upload_to, blank=True, editable=False)
+    assembled_index = models.IntegerField(default=0, editable=False)
+    assembled_size = models.BigIntegerField(default=0, editable=False)
+    size = models.BigIntegerField(null=True, default=None, editable=False)
+    chunk_size = models.BigIntegerField(null=True, default=None, editable=False)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_RECEIVING, db_index=True, editable=False)
+    lazy = models.BooleanField(default=False, editable=False)
+    segment_digests = models.TextField(blank=True, editable=False)
     
     @property
     def uploaded_file(self):
         if self._uploaded_file is None:
-            self._uploaded_file = BoundUploadedFile(self)
+            if self.lazy:
+                self._uploaded_file = self.open_segments()
+            else:
+                self._uploaded_file = BoundUploadedFile(self)
         return self._uploaded_file
     _uploaded_file = None
     
@@ -129,56 +388,431 @@ class Upload(UploadToMixin, models.Model):
         qs_expired = cls.objects.filter(created_at__lt=timezone.now() - timedelta(days=days))
         qs_lingering = cls.objects.filter(lingering=True)
         qs = qs_lingering | qs_expired
+        max_age = timedelta(days=days).total_seconds()
+        storage = UploadSegment._meta.get_field('file').storage
+        if is_local_storage(storage):
+            # segments being received are kept in temporary files next to the
+            # segment storage, which are left behind if the process dies
+            remove_stale_files(storage.path(UploadSegment.upload_to_prefix), 'tmp*.upload*', max_age)
+        for model in (cls, UploadBlob):
+            storage = model._meta.get_field('file').storage
+            if is_local_storage(storage):
+                # and so are the links BoundUploadedFile hands to forms
+                remove_stale_files(storage.path(model.upload_to_prefix), '*.handoff', max_age, recursive=True)
         return qs.delete()
     
+    @property
+    def is_materialized(self):
+        return bool(self.file) or self.lazy
+    
     @property
     def materialize_lock_key(self):
         return ';'.join(['segmented_uploads', 'Upload', str(self.pk), 'materialize'])
 
-    @transaction.atomic
+    def transition(self, status, from_statuses=None):
+        # a single update commits on its own outside of an atomic block
+        qs = Upload.objects.filter(pk=self.pk)
+        if from_statuses is not None:
+            qs = qs.filter(status__in=from_statuses)
+        transitioned = bool(qs.update(status=status))
+        if transitioned:
+            self.status = status
+        return transitioned
+    
     def materialize(self, force=False, algorithm='', **kwargs):
-        if self.file:
+        if self.is_materialized:
             raise SuspiciousOperation('already materialized')
         
         if force:
             
-            with cache_redis.lock(self.materialize_lock_key, timeout=60, blocking_timeout=-1) as lock:
+            with hold_lock(self.materialize_lock_key) as heartbeat:
+                
+                # whoever held the lock before may have assembled segments or
+                # materialized the upload since this instance was loaded
+                self.refresh_from_db(fields=['file', 'lazy', 'blob', 'partial', 'assembled_index', 'assembled_size', 'size', 'chunk_size', 'status'])
+                if self.is_materialized:
+                    raise SuspiciousOperation('already materialized')
+                
+                # the lock is held, so a materializing status was left behind by
+                # an attempt that died and it is safe to start over
+                if not self.transition(self.STATUS_MATERIALIZING, from_statuses=[self.STATUS_RECEIVING, self.STATUS_MATERIALIZING, self.STATUS_FAILED]):
+                    raise SuspiciousOperation('already materialized')
                 
                 progress_callback = kwargs.get("progress_callback", noop)
                 
-                with TemporaryFile(dir=TEMP_DIR) as fp:
-                    segments = self.segments.all()
-                    segments_len = len(segments)
-                    step_count = segments_len + 1
-                    hasher = get_hasher(algorithm)
-        
-                    for i, segment in enumerate(segments, start=1):
-                        with segment.file.open() as f:
-                            for chunk in f.chunks():
-                                fp.write(chunk)
-                                hasher.update(chunk)
-                        segment.delete()
-                        progress_callback(i, step_count)
-                        lock.reacquire()
-                        
-        
-                    fp.seek(0)
-                    self.digest = hasher.hexdigest()
-                    lock.extend(300)
-                    self.file.save('{}-{}'.format(self.pk, uuid.uuid4()), File(fp))
+                segments = self.segments.filter(offset__isnull=True)
+                segments_len = len(segments)
+                step_count = segments_len + 1
+                hasher = get_hashers(algorithm)
+                self.digest_algorithm = algorithm
+                name = '{}-{}'.format(self.pk, uuid.uuid4())
+                
+                try:
+                    if get_tree_base_algorithm(algorithm):
+                        hasher = get_hashers(algorithm, PrecomputedHasher(self.tree_digest(algorithm)))
+                    hasher = hash_in_background(hasher)
+                    blob_digest = None
+                    if self.deduplication_enabled():
+                        # hashing the segments in place first finds an identical
+                        # file before anything is written
+                        blob_hasher = hash_in_background(get_hasher(DEDUPLICATE_ALGORITHM))
+                        digest, size = self.hash_segments(MultiHasher({'file': hasher, 'blob': blob_hasher}, 'file'), heartbeat)
+                        hasher = PrecomputedHasher(digest, digests=get_hexdigests(hasher, algorithm))
+                        blob_digest = blob_hasher.hexdigest()
+                    if getattr(settings, 'UPLOADS_MATERIALIZE_LAZILY', False):
+                        self.materialize_lazily(hasher, heartbeat)
+                    elif blob_digest is not None and self.materialize_from_blob(hasher, blob_digest, size):
+                        pass
+                    elif self.can_materialize_locally():
+                        self.materialize_locally(name, segments, hasher, heartbeat, progress_callback, step_count)
+                    elif getattr(settings, 'UPLOADS_MATERIALIZE_STREAMING', False):
+                        self.materialize_streaming(name, segments, hasher, heartbeat, progress_callback, step_count)
+                    else:
+                        with TemporaryFile(dir=TEMP_DIR) as fp, closing(self.segment_chunks(segments)) as iterator:
+                            for i, (segment, chunks) in enumerate(iterator, start=1):
+                                for chunk in chunks:
+                                    fp.write(chunk)
+                                    hasher.update(chunk)
+                                progress_callback(i, step_count)
+                                heartbeat.check()
+                            
+                            fp.seek(0)
+                            self.set_digest(hasher)
+                            self.status = self.STATUS_READY
+                            self.file.save(name, File(fp))
+                except BaseException:
+                    self.transition(self.STATUS_FAILED)
+                    raise
+                
+                if self.file:
+                    if blob_digest is not None and self.blob_id is None:
+                        self.share_file(blob_digest)
+                    self.record_segment_digests()
+                    # the file is durable, so the segments can go
+                    self.delete_segments()
                 
                 progress_callback(step_count, step_count)
         
         else:
             return self.trigger(algorithm)
     
+    def materialize_lazily(self, hasher, heartbeat):
+        if hasher is not noop_hasher:
+            self.hash_segments(hasher, heartbeat)
+        elif self.is_offset_addressed:
+            self.verify_offsets()
+        self.set_digest(hasher)
+        self.lazy = True
+        self.status = self.STATUS_READY
+        self.save()
+    
+    def set_digest(self, hasher):
+        self.digest = hasher.hexdigest()
+        self.set_digests(get_hexdigests(hasher, self.digest_algorithm))
+    
+    def tree_digest(self, algorithm):
+        base = get_tree_base_algorithm(algorithm)
+        hasher = get_hasher(base)
+        for segment in self.segments.all():
+            hasher.update(force_bytes(segment.get_digest(base)))
+        return hasher.hexdigest()
+    
+    def hash_segments(self, hasher, heartbeat):
+        with self.open_segments() as f:
+            if not isinstance(hasher, NoopHasher):
+                for chunk in f.chunks():
+                    hasher.update(chunk)
+                    heartbeat.check()
+            return hasher.hexdigest(), f.size
+    
+    @classmethod
+    def deduplication_enabled(cls):
+        if getattr(settings, 'UPLOADS_MATERIALIZE_LAZILY', False):
+            return False
+        return getattr(settings, 'UPLOADS_DEDUPLICATE', False)
+    
+    def materialize_from_blob(self, hasher, blob_digest, size):
+        blob = UploadBlob.acquire(DEDUPLICATE_ALGORITHM, blob_digest, size)
+        if blob is None:
+            return False
+        partial = self.partial.name
+        self.partial.name = ''
+        self.file.name = blob.file.name
+        self.blob = blob
+        self.set_digest(hasher)
+        self.status = self.STATUS_READY
+        self.save()
+        if partial:
+            self.partial.storage.delete(partial)
+        return True
+    
+    def materialize_from_copy(self, algorithm, digest, size):
+        # the digest comes from the client, so only uploads of the same user or session match
+        with hold_lock(self.materialize_lock_key):
+            if not self.transition(self.STATUS_MATERIALIZING, from_statuses=[self.STATUS_RECEIVING, self.STATUS_MATERIALIZING, self.STATUS_FAILED]):
+                raise SuspiciousOperation('already materialized')
+            blob = UploadBlob.held_by(
+                user=self.user_id,
+                session=self.session,
+                algorithm=DEDUPLICATE_ALGORITHM,
+                size=size,
+                reference_count__gt=0,
+                uploads__digest_algorithm=algorithm,
+                uploads__digest=digest,
+            ).first()
+            if blob is None:
+                self.transition(self.STATUS_RECEIVING)
+                return False
+            self.digest_algorithm = algorithm
+            try:
+                shared = self.materialize_from_blob(PrecomputedHasher(digest), blob.digest, size)
+            except BaseException:
+                self.transition(self.STATUS_FAILED)
+                raise
+            if not shared:
+                # released since
+                self.transition(self.STATUS_RECEIVING)
+                return False
+            self.delete_segments()
+            return True
+    
+    def share_file(self, blob_digest):
+        blob = UploadBlob.acquire(DEDUPLICATE_ALGORITHM, blob_digest, self.file.size, name=self.file.name)
+        if blob is None:
+            return
+        name = self.file.name
+        self.file.name = blob.file.name
+        self.blob = blob
+        self.save(update_fields=['file', 'blob'])
+        if name != blob.file.name:
+            self.file.storage.delete(name)
+    
+    def record_segment_digests(self):
+        # lets identical segments be copied out of the file once the segments are gone
+        entries = []
+        offset = 0
+        for size, digest_algorithm, digest, digests in self.segments.values_list('size', 'digest_algorithm', 'digest', 'digests'):
+            if size is None:
+                return
+            digests = json.loads(digests) if digests else {}
+            if digest:
+                digests.setdefault(digest_algorithm, digest)
+            if digests:
+                entries.append([offset, size, digests])
+            offset += size
+        if entries and offset == self.file.size:
+            self.segment_digests = json.dumps(entries, sort_keys=True)
+            Upload.objects.filter(pk=self.pk).update(segment_digests=self.segment_digests)
+    
+    def read_segment(self, algorithm, digest, size):
+        for offset, segment_size, digests in json.loads(self.segment_digests or '[]'):
+            if segment_size == size and digests.get(algorithm) == digest:
+                with self.file.open() as f:
+                    f.seek(offset)
+                    return f.read(size), digests
+        return None
+    
+    def get_segment_parts(self):
+        def opener(field):
+            return lambda storage=field.storage, name=field.name: storage.open(name)
+        if self.is_offset_addressed:
+            self.verify_offsets()
+            return [(opener(self.partial), 0, self.size)]
+        parts = []
+        for segment in self.segments.all():
+            if segment.is_assembled:
+                if not self.partial:
+                    raise FileNotFoundError
+                parts.append((opener(self.partial), segment.offset, segment.size))
+            elif segment.file:
+                parts.append((opener(segment.file), 0, segment.file.size))
+            else:
+                raise FileNotFoundError
+        return parts
+    
+    def open_segments(self):
+        return SegmentedUploadedFile(self)
+    
+    def delete_segments(self):
+        # nothing references segments and their files are deleted right here, so
+        # the signals and cascades of QuerySet.delete() have nothing left to do
+        db = router.db_for_write(UploadSegment, instance=self)
+        connection = connections[db]
+        qn = connection.ops.quote_name
+        sql = 'DELETE FROM {table} WHERE {upload} = %s'.format(
+            table=qn(UploadSegment._meta.db_table),
+            upload=qn(UploadSegment._meta.get_field('upload').column),
+        )
+        with connection.cursor() as cursor:
+            if supports_returning(connection):
+                cursor.execute(sql + ' RETURNING {}'.format(qn(UploadSegment._meta.get_field('file').column)), [self.pk])
+                names = [name for name, in cursor.fetchall() if name]
+            else:
+                rows = list(self.segments.values_list('pk', 'file'))
+                names = [name for pk, name in rows if name]
+                # a segment received after the read keeps its row along with its file
+                sql += ' AND {} IN '.format(qn(UploadSegment._meta.pk.column))
+                for start in range(0, len(rows), 500):
+                    pks = [pk for pk, name in rows[start:start + 500]]
+                    cursor.execute(sql + '({})'.format(', '.join(['%s'] * len(pks))), [self.pk] + pks)
+        if names:
+            storage = UploadSegment._meta.get_field('file').storage
+            workers = getattr(settings, 'UPLOADS_SEGMENT_DELETE_WORKERS', 0)
+            transaction.on_commit(lambda: delete_files(storage, names, workers=workers))
+    
+    def segment_chunks(self, segments):
+        return segment_chunks(
+            segments,
+            prefetch=getattr(settings, 'UPLOADS_MATERIALIZE_PREFETCH', 0),
+            buffer_size=getattr(settings, 'UPLOADS_MATERIALIZE_PREFETCH_BUFFER_SIZE', 67108864),
+        )
+    
+    def segment_files(self, segments):
+        return segment_files(segments, prefetch=getattr(settings, 'UPLOADS_MATERIALIZE_PREFETCH', 0))
+    
+    def can_materialize_locally(self):
+        # segments on other storages are read through it while assembling
+        return self.is_offset_addressed or is_local_storage(self.file.storage)
+    
+    def materialize_locally(self, name, segments, hasher, heartbeat, progress_callback, step_count):
+        # progress is recorded per segment, so a retry continues after the last assembled one
+        storage = self.file.storage
+        name = storage.get_available_name(self.file.field.generate_filename(self, name))
+        path = storage.path(name)
+        created = False if self.is_offset_addressed else self.ensure_partial()
+        partial_path = self.partial.path
+        try:
+            if self.is_offset_addressed:
+                self.verify_offsets()
+            else:
+                self.assemble(heartbeat, segments=segments, contiguous=False, progress_callback=progress_callback, step_count=step_count)
+            if not isinstance(hasher, NoopHasher):
+                with self.partial.open() as f:
+                    for chunk in f.chunks():
+                        hasher.update(chunk)
+            if storage.file_permissions_mode is not None:
+                os.chmod(partial_path, storage.file_permissions_mode)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.rename(partial_path, path)
+        except BaseException:
+            if created and not self.assembled_index:
+                # nothing worth resuming from
+                os.remove(partial_path)
+                Upload.objects.filter(pk=self.pk).update(partial='')
+                self.partial.name = ''
+            raise
+        self.set_digest(hasher)
+        self.file.name = name
+        self.partial.name = ''
+        self.status = self.STATUS_READY
+        self.save()
+    
+    def assembles_incrementally(self):
+        return getattr(settings, 'UPLOADS_ASSEMBLY_MODE', 'segments') == 'incremental' and self.can_materialize_locally()
+    
+    def assemble_incrementally(self):
+        with hold_lock(self.materialize_lock_key) as heartbeat:
+            self.refresh_from_db(fields=['file', 'partial', 'assembled_index', 'assembled_size'])
+            if not self.file:
+                self.ensure_partial()
+                self.assemble(heartbeat)
+    
+    def create_partial(self):
+        storage = self.partial.storage
+        name = '{}-{}.partial'.format(self.pk, uuid.uuid4())
+        name = storage.get_available_name(self.partial.field.generate_filename(self, name))
+        path = storage.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, 'xb').close()
+        return name, path
+    
+    def ensure_partial(self):
+        if self.partial:
+            return False
+        self.partial.name = self.create_partial()[0]
+        Upload.objects.filter(pk=self.pk).update(partial=self.partial.name)
+        return True
+    
+    @property
+    def is_offset_addressed(self):
+        return self.chunk_size is not None
+    
+    def assembles_by_offset(self):
+        return getattr(settings, 'UPLOADS_ASSEMBLY_MODE', 'segments') == 'offset' and is_local_storage(self.file.storage)
+    
+    def preallocate(self, size, chunk_size):
+        # sparse, so only the segments written to it take disk space
+        if not self.partial:
+            name, path = self.create_partial()
+            with open(path, 'r+b', buffering=0) as fp:
+                os.ftruncate(fp.fileno(), size)
+            if Upload.objects.filter(pk=self.pk, partial='').update(partial=name, size=size, chunk_size=chunk_size):
+                self.partial.name, self.size, self.chunk_size = name, size, chunk_size
+            else:
+                # another request beat us to it
+                os.remove(path)
+                self.refresh_from_db(fields=['partial', 'size', 'chunk_size'])
+        if (self.size, self.chunk_size) != (size, chunk_size):
+            raise SuspiciousOperation('Upload size cannot change!')
+    
+    def verify_offsets(self):
+        received = self.segments.filter(offset__isnull=False).aggregate(count=models.Count('pk'), size=models.Sum('size'))
+        expected_count = -(-self.size // self.chunk_size)
+        if received['count'] != expected_count or (received['size'] or 0) != self.size:
+            raise SuspiciousOperation('Upload is incomplete!')
+    
+    def assemble(self, heartbeat, segments=None, contiguous=True, progress_callback=noop, step_count=None):
+        if segments is None:
+            segments = self.segments.filter(offset__isnull=True)
+        segments = segments.filter(index__gt=self.assembled_index)
+        with open(self.partial.path, 'r+b', buffering=0) as fp, closing(self.segment_files(segments)) as files:
+            # discard anything appended by an attempt that did not record its progress
+            fp.truncate(self.assembled_size)
+            fp.seek(self.assembled_size)
+            for i, (segment, src) in enumerate(files, start=1):
+                if contiguous and segment.index != self.assembled_index + 1:
+                    break
+                append_segment(segment, fp.fileno(), src)
+                size = fp.tell()
+                with transaction.atomic():
+                    name = segment.file.name
+                    segment.file.name = ''
+                    segment.offset = self.assembled_size
+                    segment.size = size - self.assembled_size
+                    segment.save(update_fields=['file', 'offset', 'size'])
+                    self.assembled_index = segment.index
+                    self.assembled_size = size
+                    Upload.objects.filter(pk=self.pk).update(assembled_index=segment.index, assembled_size=size)
+                    transaction.on_commit(lambda name=name, storage=segment.file.storage: storage.delete(name))
+                progress_callback(i, step_count)
+                heartbeat.check()
+    
+    def materialize_streaming(self, name, segments, hasher, heartbeat, progress_callback, step_count):
+        storage = self.file.storage
+        name = storage.get_available_name(self.file.field.generate_filename(self, name))
+        try:
+            with storage.open(name, 'wb') as fp, closing(self.segment_chunks(segments)) as iterator:
+                for i, (segment, chunks) in enumerate(iterator, start=1):
+                    for chunk in chunks:
+                        fp.write(chunk)
+                        hasher.update(chunk)
+                    progress_callback(i, step_count)
+                    heartbeat.check()
+        except BaseException:
+            storage.delete(name)
+            raise
+        self.set_digest(hasher)
+        self.file.name = name
+        self.status = self.STATUS_READY
+        self.save()
+    
     @property
     def trigger_lock_key(self):
         return ';'.join(['segmented_uploads', 'Upload', str(self.pk), 'trigger'])
     
     def trigger(self, algorithm):
-        with cache_redis.lock(self.trigger_lock_key, timeout=5, blocking_timeout=-1) as lock:
-            return trigger_materialization.send(sender=self.__class__, instance=self, algorithm=algorithm, lock=lock)
+        with hold_lock(self.trigger_lock_key) as heartbeat:
+            return trigger_materialization.send(sender=self.__class__, instance=self, algorithm=algorithm, lock=heartbeat.lock)
 
 
 if getattr(settings, 'UPLOADS_MATERIALIZE_SYNCHRONOUSLY', True):
@@ -201,30 +835,211 @@ class UploadSecret(models.Model):
     )
 
 
-class UploadSegment(UploadToMixin, models.Model):
+class UploadSegment(DigestsMixin, HeldByMixin, UploadToMixin, models.Model):
     upload_to_prefix = 'upload-segments/'
+    held_by_prefix = 'upload__'
     
     class Meta:
         ordering = ["index"]
         unique_together = ("index", "upload")
+        indexes = [
+            models.Index(fields=["digest", "digest_algorithm"], name="segment_digest_idx"),
+        ]
 
-    file = models.FileField(upload_to=UploadToMixin.upload_to)
+    file = models.FileField(upload_to=UploadToMixin.upload_to, blank=True)
     index = models.IntegerField(db_index=True)
     upload = models.ForeignKey(Upload, related_name="segments", on_delete=models.CASCADE)
     attempt_count = models.IntegerField(default=0)
     
-    def get_digest(self, **kwargs):
+    offset = models.BigIntegerField(null=True, default=None, editable=False)
+    size = models.BigIntegerField(null=True, default=None, editable=False)
+    digest_algorithm = models.CharField(max_length=32, blank=True, editable=False)
+    digest = models.CharField(max_length=DIGEST_MAX_LENGTH, blank=True, editable=False)
+    digests = models.TextField(blank=True, editable=False)
+    
+    @property
+    def is_assembled(self):
+        return self.offset is not None
+    
+    @classmethod
+    def record_attempt(cls, upload, index):
+        # a single upsert keeps concurrent attempts from losing increments
+        db = router.db_for_write(cls, instance=upload)
+        connection = connections[db]
+        if not supports_returning(connection):
+            segment = cls.objects.get_or_create(upload=upload, index=index)[0]
+            cls.objects.filter(pk=segment.pk).update(attempt_count=models.F('attempt_count') + 1)
+            segment.attempt_count += 1
+            return segment
+        segment = cls(upload=upload, index=index, attempt_count=1)
+        qn = connection.ops.quote_name
+        table = qn(cls._meta.db_table)
+        fields = cls._meta.concrete_fields
+        insert_fields = [f for f in fields if not f.primary_key]
+        attempt_count = qn(cls._meta.get_field('attempt_count').column)
+        sql = 'INSERT INTO {table} ({columns}) VALUES ({values}) ON CONFLICT ({unique}) DO UPDATE SET {attempt_count} = {table}.{attempt_count} + 1 RETURNING {returning}'.format(
+            table=table,
+            columns=', '.join(qn(f.column) for f in insert_fields),
+            values=', '.join(['%s'] * len(insert_fields)),
+            unique=', '.join(qn(cls._meta.get_field(name).column) for name in ('index', 'upload')),
+            attempt_count=attempt_count,
+            returning=', '.join('{}.{}'.format(table, qn(f.column)) for f in fields),
+        )
+        params = [f.get_db_prep_save(f.pre_save(segment, True), connection) for f in insert_fields]
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            row = cursor.fetchone()
+        segment = cls.from_db(db, [f.attname for f in fields], row)
+        segment.upload = upload
+        return segment
+    
+    def exists(self):
+        if self.is_assembled:
+            return True
+        return bool(self.file) and self.file.storage.exists(self.file.name)
+    
+    def read(self):
+        if self.is_assembled:
+            partial = self.upload.partial
+            if not partial:
+                raise FileNotFoundError
+            with partial.open() as f:
+                f.seek(self.offset)
+                return f.read(self.size)
+        if not self.file:
+            raise FileNotFoundError
+        with self.file.open() as f:
+            return self.file.read()
+    
+    def chunks(self, chunk_size=None):
+        chunk_size = chunk_size or File.DEFAULT_CHUNK_SIZE
+        if self.is_assembled:
+            partial = self.upload.partial
+            if not partial:
+                raise FileNotFoundError
+            with partial.open() as f:
+                f.seek(self.offset)
+                remaining = self.size
+                while remaining > 0:
+                    chunk = f.read(min(chunk_size, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    yield chunk
+            return
         if not self.file:
             raise FileNotFoundError
+        with self.file.open() as f:
+            yield from f.chunks(chunk_size)
+    
+    def overwrite_assembled(self, uploaded_file, algorithm=''):
+        # the following segments are already in place, so the size cannot change
+        if uploaded_file.size != self.size:
+            raise SuspiciousOperation('Assembled segment cannot change size!')
+        hasher = get_uploaded_file_hasher(uploaded_file, algorithm)
+        with open(self.upload.partial.path, 'r+b', buffering=0) as fp:
+            fp.seek(self.offset)
+            for chunk in uploaded_file.chunks():
+                fp.write(chunk)
+                hasher.update(chunk)
+        self.set_digest(algorithm, hasher)
+    
+    def write_at_offset(self, uploaded_file, algorithm=''):
+        upload = self.upload
+        index = int(self.index)
+        offset = (index - 1) * upload.chunk_size
+        end = offset + uploaded_file.size
+        if index < 1 or upload.size < end or (uploaded_file.size != upload.chunk_size and end != upload.size):
+            raise SuspiciousOperation('Segment does not fit the upload!')
+        hasher = get_uploaded_file_hasher(uploaded_file, algorithm)
+        with open(upload.partial.path, 'r+b', buffering=0) as fp:
+            position = offset
+            for chunk in uploaded_file.chunks():
+                position = pwrite_all(fp.fileno(), chunk, position)
+                hasher.update(chunk)
+        self.offset = offset
+        self.size = uploaded_file.size
+        self.set_digest(algorithm, hasher)
+        self.save(update_fields=['offset', 'size', 'digest_algorithm', 'digest', 'digests'])
+    
+    def hash_uploaded_file(self, uploaded_file, algorithm=''):
+        hasher = get_uploaded_file_hasher(uploaded_file, algorithm)
+        if not isinstance(hasher, NoopHasher):
+            for chunk in uploaded_file.chunks():
+                hasher.update(chunk)
+        self.set_digest(algorithm, hasher)
+    
+    def set_digest(self, algorithm, hasher):
+        self.digest = hasher.hexdigest()
+        self.digest_algorithm = algorithm if self.digest else ''
+        self.set_digests(get_hexdigests(hasher, algorithm))
+    
+    def get_digest(self, algorithm=''):
+        # Prefer the digest computed when the segment was received so checks
+        # don't have to touch storage
+        digest = self.get_digests().get(algorithm) if algorithm else None
+        if digest:
+            return digest
+        if getattr(settings, 'UPLOADS_HASH_BUFFERS', 0):
+            # reading the next chunk overlaps with hashing the previous one
+            hasher = hash_in_background(get_hasher(algorithm))
+            for chunk in self.chunks():
+                hasher.update(chunk)
+            return hasher.hexdigest()
         # Individual segments are size limited, so it is acceptable to read them
         # into memory.  The default limit is 10MB.
-        with self.file.open() as f:
-            data = self.file.read()
-        return Upload.hexdigest(data, **kwargs)
+        return Upload.hexdigest(self.read(), algorithm=algorithm)
+
+
+class UploadBlob(HeldByMixin, UploadToMixin, models.Model):
+    upload_to_prefix = 'upload-blobs/'
+    held_by_prefix = 'uploads__'
+    
+    class Meta:
+        unique_together = ("algorithm", "digest", "size")
+    
+    algorithm = models.CharField(max_length=32)
+    digest = models.CharField(max_length=DIGEST_MAX_LENGTH)
+    size = models.BigIntegerField()
+    file = models.FileField(upload_to=UploadToMixin.upload_to)
+    reference_count = models.IntegerField(default=0)
+    
+    @classmethod
+    def acquire(cls, algorithm, digest, size, name=''):
+        lookups = {'algorithm': algorithm, 'digest': digest, 'size': size}
+        for attempt in range(2):
+            # a blob without references is being released and cannot be revived
+            if cls.objects.filter(reference_count__gt=0, **lookups).update(reference_count=models.F('reference_count') + 1):
+                return cls.objects.get(**lookups)
+            if not name:
+                return None
+            try:
+                with transaction.atomic():
+                    return cls.objects.create(file=name, reference_count=1, **lookups)
+            except IntegrityError:
+                # created concurrently, so share that one instead
+                continue
+        return None
+    
+    @classmethod
+    def release(cls, pk):
+        cls.objects.filter(pk=pk).update(reference_count=models.F('reference_count') - 1)
+        # deleting the last reference removes the file through cleanup_file
+        cls.objects.filter(pk=pk, reference_count__lte=0).delete()
 
 
 @receiver(post_delete, sender=Upload)
 @receiver(post_delete, sender=UploadSegment)
+@receiver(post_delete, sender=UploadBlob)
 def cleanup_file(sender, instance, **kwargs):
+    if sender is Upload and instance.blob_id is not None:
+        # the file is shared, so only the reference goes
+        UploadBlob.release(instance.blob_id)
+        return
     # Pass False so FileField doesn't save the model.
     transaction.on_commit(lambda: instance.file.delete(False))
+
+
+@receiver(post_delete, sender=Upload)
+def cleanup_partial(sender, instance, **kwargs):
+    transaction.on_commit(lambda: instance.partial.delete(False))
@@ -0,0 +1,214 @@
+import errno
+import io
+import os
+import threading
+from tempfile import TemporaryDirectory
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage, Storage
+from django.test import SimpleTestCase
+
+from ..files import SegmentsFile, append_file, append_segment, delete_files, is_local_storage, open_local_segment, segment_chunks, segment_files
+
+
+class AppendFileTests(SimpleTestCase):
+    def setUp(self):
+        self.tempdir = TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.dst_path = os.path.join(self.tempdir.name, 'dst')
+        self.sources = []
+        for i, data in enumerate((b'one,', b'', b'two,' * 1024, b'three')):
+            path = os.path.join(self.tempdir.name, str(i))
+            with open(path, 'wb') as fp:
+                fp.write(data)
+            self.sources.append(path)
+        self.expected = b'one,' + b'two,' * 1024 + b'three'
+    
+    def append_sources(self):
+        with open(self.dst_path, 'wb', buffering=0) as fp:
+            for path in self.sources:
+                append_file(path, fp.fileno())
+        with open(self.dst_path, 'rb') as fp:
+            return fp.read()
+    
+    def test_append_file(self):
+        self.assertEqual(self.append_sources(), self.expected)
+    
+    def test_append_file_falls_back_to_sendfile(self):
+        with patch('segmented_uploads.files._copy_file_range', side_effect=OSError(errno.EXDEV, 'cross device')):
+            self.assertEqual(self.append_sources(), self.expected)
+    
+    def test_append_file_falls_back_to_userspace(self):
+        error = OSError(errno.ENOSYS, 'not implemented')
+        with patch('segmented_uploads.files._copy_file_range', side_effect=error):
+            with patch('segmented_uploads.files._sendfile', side_effect=error):
+                self.assertEqual(self.append_sources(), self.expected)
+    
+    def test_append_file_raises_unexpected_errors(self):
+        with patch('segmented_uploads.files._copy_file_range', side_effect=OSError(errno.ENOSPC, 'no space')):
+            with self.assertRaises(OSError):
+                self.append_sources()
+
+
+class IsLocalStorageTests(SimpleTestCase):
+    def test_is_local_storage(self):
+        self.assertTrue(is_local_storage(FileSystemStorage()))
+        self.assertFalse(is_local_storage(Storage()))
+
+
+class DeleteFilesTests(SimpleTestCase):
+    def test_delete_files(self):
+        with TemporaryDirectory() as location:
+            storage = FileSystemStorage(location=location)
+            for workers in (0, 4):
+                with self.subTest(workers=workers):
+                    names = [storage.save(str(i), ContentFile(b'%d' % i)) for i in range(10)]
+                    delete_files(storage, names, workers=workers)
+                    self.assertEqual(os.listdir(location), [])
+
+
+class FakeSegment(SimpleNamespace):
+    def __init__(self, data, error=None):
+        super().__init__(file=ContentFile(data), error=error)
+        if error:
+            self.file.chunks = self.raise_error
+    
+    def raise_error(self, *args, **kwargs):
+        raise self.error
+
+
+class AppendSegmentTests(SimpleTestCase):
+    def test_append_segment_from_other_storage(self):
+        segment = FakeSegment(b'some-data' * 1024)
+        segment.file.storage = Storage()
+        with TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'dst')
+            with open(path, 'wb', buffering=0) as fp:
+                fp.write(b'prefix,')
+                with patch('segmented_uploads.files.append_file') as mocked_function:
+                    append_segment(segment, fp.fileno())
+                    mocked_function.assert_not_called()
+            with open(path, 'rb') as fp:
+                self.assertEqual(fp.read(), b'prefix,' + b'some-data' * 1024)
+
+
+class SegmentChunksTests(SimpleTestCase):
+    def setUp(self):
+        self.segments = [FakeSegment(b'%d,' % i * 1024) for i in range(10)]
+    
+    def consume(self, **kwargs):
+        return [(segment, b''.join(chunks)) for segment, chunks in segment_chunks(self.segments, **kwargs)]
+    
+    def test_order_is_preserved(self):
+        for prefetch in (0, 1, 3, 20):
+            with self.subTest(prefetch=prefetch):
+                result = self.consume(prefetch=prefetch, buffer_size=4096)
+                self.assertEqual([segment for segment, data in result], self.segments)
+                self.assertEqual([data for segment, data in result], [b'%d,' % i * 1024 for i in range(10)])
+    
+    def test_errors_are_raised_in_order(self):
+        self.segments[3] = FakeSegment(b'', error=ValueError('boom'))
+        iterator = segment_chunks(self.segments, prefetch=2, buffer_size=4096)
+        for i in range(3):
+            segment, chunks = next(iterator)
+            self.assertIs(segment, self.segments[i])
+            list(chunks)
+        segment, chunks = next(iterator)
+        with self.assertRaisesMessage(ValueError, 'boom'):
+            list(chunks)
+        iterator.close()
+    
+    def test_abandoned_iteration_stops_readers(self):
+        count = threading.active_count()
+        iterator = segment_chunks(self.segments, prefetch=3, buffer_size=1)
+        segment, chunks = next(iterator)
+        next(chunks)
+        self.assertLess(count, threading.active_count())
+        iterator.close()
+        self.assertEqual(count, threading.active_count())
+
+
+class SegmentFilesTests(SimpleTestCase):
+    def setUp(self):
+        self.tempdir = TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        storage = FileSystemStorage(location=self.tempdir.name)
+        self.segments = [FakeSegment(b'remote,')]
+        self.segments[0].file.storage = Storage()
+        for i in range(5):
+            name = storage.save(str(i), ContentFile(b'%d,' % i * 1024))
+            self.segments.append(SimpleNamespace(file=SimpleNamespace(storage=storage, path=storage.path(name))))
+        self.expected = b'remote,' + b''.join(b'%d,' % i * 1024 for i in range(5))
+        self.opened = []
+        def record_open(segment):
+            src = open_local_segment(segment)
+            self.opened.append(src)
+            return src
+        patcher = patch('segmented_uploads.files.open_local_segment', side_effect=record_open)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+    
+    def test_segments_are_appended_in_order(self):
+        for prefetch in (0, 1, 3, 20):
+            with self.subTest(prefetch=prefetch):
+                del self.opened[:]
+                path = os.path.join(self.tempdir.name, 'dst-%d' % prefetch)
+                with open(path, 'wb', buffering=0) as fp:
+                    for segment, src in segment_files(self.segments, prefetch=prefetch):
+                        append_segment(segment, fp.fileno(), src)
+                with open(path, 'rb') as fp:
+                    self.assertEqual(fp.read(), self.expected)
+                self.assertEqual(len(self.opened), 5 if prefetch else 0)
+                self.assertTrue(all(src.closed for src in self.opened))
+    
+    def test_following_segments_are_opened_ahead(self):
+        iterator = segment_files(self.segments, prefetch=2)
+        segment, src = next(iterator)
+        self.assertIs(segment, self.segments[0])
+        self.assertIsNone(src)
+        segment, src = next(iterator)
+        self.assertIs(segment, self.segments[1])
+        self.assertEqual(src.read(), b'0,' * 1024)
+        iterator.close()
+        self.assertEqual(len(self.opened), 3)
+        self.assertTrue(all(src.closed for src in self.opened))
+
+
+class SegmentsFileTests(SimpleTestCase):
+    def setUp(self):
+        partial = b'xxone,two,xx'
+        parts = [
+            (lambda: io.BytesIO(partial), 2, 4),
+            (lambda: io.BytesIO(b''), 0, 0),
+            (lambda: io.BytesIO(partial), 6, 4),
+            (lambda: io.BytesIO(b'three'), 0, 5),
+        ]
+        self.file = SegmentsFile(parts)
+        self.addCleanup(self.file.close)
+    
+    def test_size(self):
+        self.assertEqual(self.file.size, 13)
+    
+    def test_read(self):
+        self.assertEqual(self.file.read(), b'one,two,three')
+        self.assertEqual(self.file.read(), b'')
+    
+    def test_read_across_parts(self):
+        self.assertEqual(b''.join(iter(lambda: self.file.read(3), b'')), b'one,two,three')
+    
+    def test_seek(self):
+        self.assertEqual(self.file.seek(6), 6)
+        self.assertEqual(self.file.read(4), b'o,th')
+        self.assertEqual(self.file.seek(-2, io.SEEK_CUR), 8)
+        self.assertEqual(self.file.read(), b'three')
+        self.assertEqual(self.file.seek(-9, io.SEEK_END), 4)
+        self.assertEqual(self.file.read(), b'two,three')
+        with self.assertRaises(ValueError):
+            self.file.seek(-1)
+    
+    def test_truncated_part(self):
+        f = SegmentsFile([(lambda: io.BytesIO(b'on'), 0, 4)])
+        with self.assertRaises(IOError):
+            f.read()
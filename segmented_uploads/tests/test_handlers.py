@@ -0,0 +1,65 @@
+import os
+from unittest.mock import patch
+
+from django.test import RequestFactory, TestCase, override_settings
+
+from ..handlers import SegmentTemporaryUploadedFile, SegmentUploadHandler, get_segment_temp_dir
+from ..models import Upload, UploadSegment
+
+
+class SegmentUploadHandlerTests(TestCase):
+    def receive(self, data, algorithm=''):
+        request = RequestFactory().post('/?algorithm=%s' % algorithm if algorithm else '/')
+        handler = SegmentUploadHandler(request)
+        handler.new_file('file', 'segment.txt', 'text/plain', len(data))
+        for start in range(0, len(data), 4):
+            handler.receive_data_chunk(data[start:start + 4], start)
+        return handler.file_complete(len(data))
+    
+    def test_file_complete(self):
+        f = self.receive(b'some content')
+        self.addCleanup(f.close)
+        self.assertIsInstance(f, SegmentTemporaryUploadedFile)
+        self.assertEqual(f.read(), b'some content')
+        self.assertEqual(f.size, 12)
+        self.assertEqual(f.digests, {})
+    
+    def test_digest(self):
+        for algo, expected in (
+            ('md5', '9893532233caff98cd083a116b013c0b'),
+            ('sha1', '94e66df8cd09d410c62d9e0dc59d3a884e458e05'),
+            ('unknown', None),
+        ):
+            with self.subTest(algorithm=algo):
+                f = self.receive(b'some content', algorithm=algo)
+                self.addCleanup(f.close)
+                self.assertEqual(f.digests.get(algo), expected)
+    
+    def test_temporary_file_is_kept_with_segments(self):
+        f = self.receive(b'some content')
+        self.addCleanup(f.close)
+        self.assertEqual(os.path.dirname(f.temporary_file_path()), get_segment_temp_dir())
+    
+    def test_saving_segment_moves_temporary_file(self):
+        f = self.receive(b'some content', algorithm='md5')
+        self.addCleanup(f.close)
+        path = f.temporary_file_path()
+        segment = UploadSegment(index=1, upload=Upload.objects.create(token='some-token', session='some-session'))
+        segment.hash_uploaded_file(f, algorithm='md5')
+        segment.file.save('segment', f)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(segment.file.read(), b'some content')
+        self.assertEqual(segment.digest, '9893532233caff98cd083a116b013c0b')
+    
+    @override_settings(UPLOADS_DIGEST_ALGORITHMS=['sha1'])
+    def test_further_digests_are_stored(self):
+        f = self.receive(b'some content', algorithm='md5')
+        self.addCleanup(f.close)
+        segment = UploadSegment(index=1, upload=Upload.objects.create(token='some-token', session='some-session'))
+        segment.hash_uploaded_file(f, algorithm='md5')
+        expected = {'md5': '9893532233caff98cd083a116b013c0b', 'sha1': '94e66df8cd09d410c62d9e0dc59d3a884e458e05'}
+        self.assertEqual(f.digests, expected)
+        self.assertEqual(segment.get_digests(), expected)
+        with patch.object(UploadSegment, 'read') as mocked_method:
+            self.assertEqual(segment.get_digest('sha1'), expected['sha1'])
+            mocked_method.assert_not_called()
@@ -0,0 +1,83 @@
+from tempfile import TemporaryDirectory
+from unittest import skipUnless
+
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from redis.exceptions import LockError as RedisLockError
+
+from ..locks import FileLock, LockError, PostgresAdvisoryLock, RedisLock, get_lock
+
+
+class CommonLockTestsMixin(object):
+    name = 'segmented_uploads;tests;lock'
+    
+    def get_lock(self, name=None):
+        return self.backend(name or self.name, 5)
+    
+    def test_lock_is_exclusive(self):
+        lock = self.get_lock()
+        self.assertTrue(lock.acquire())
+        try:
+            self.assertFalse(self.get_lock().acquire())
+            other = self.get_lock(self.name + ';other')
+            self.assertTrue(other.acquire())
+            other.release()
+        finally:
+            lock.release()
+        lock = self.get_lock()
+        self.assertTrue(lock.acquire())
+        lock.release()
+    
+    def test_context_manager(self):
+        with self.get_lock() as lock:
+            with self.assertRaises(LockError):
+                with self.get_lock():
+                    pass
+            lock.extend(10)
+            lock.reacquire()
+        with self.get_lock():
+            pass
+    
+    def test_released_lock_is_not_held(self):
+        lock = self.get_lock()
+        self.assertTrue(lock.acquire())
+        lock.release()
+        for method, args in (('reacquire', ()), ('extend', (10,)), ('release', ())):
+            with self.subTest(method=method):
+                with self.assertRaises(LockError):
+                    getattr(lock, method)(*args)
+
+
+class RedisLockTests(CommonLockTestsMixin, SimpleTestCase):
+    backend = RedisLock
+
+
+class FileLockTests(CommonLockTestsMixin, SimpleTestCase):
+    backend = FileLock
+    
+    def setUp(self):
+        super().setUp()
+        tempdir = TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        settings = override_settings(UPLOADS_LOCK_DIR=tempdir.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'requires PostgreSQL')
+class PostgresAdvisoryLockTests(CommonLockTestsMixin, TestCase):
+    backend = PostgresAdvisoryLock
+
+
+class GetLockTests(SimpleTestCase):
+    def test_default_backend(self):
+        lock = get_lock('some-lock', 5)
+        self.assertIsInstance(lock, RedisLock)
+        self.assertEqual((lock.name, lock.timeout), ('some-lock', 5))
+    
+    @override_settings(UPLOADS_LOCK_BACKEND='segmented_uploads.locks.FileLock')
+    def test_backend_setting(self):
+        self.assertIsInstance(get_lock('some-lock', 5), FileLock)
+    
+    def test_lock_error_is_redis_lock_error(self):
+        self.assertTrue(issubclass(LockError, RedisLockError))
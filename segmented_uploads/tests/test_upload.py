@@ -1,20 +1,26 @@
+import os
+from hashlib import sha3_256
 from unittest.mock import patch, ANY as MOCK_ANY
 
 from django.contrib.auth import get_user_model
 from django.core.exceptions import SuspiciousOperation, ValidationError
 from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
 from django.db import IntegrityError, transaction
+from django.db.models import QuerySet
+from django.db.models.signals import post_delete
 from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
-from redis.exceptions import LockError as RedisLockError
 
-from ..models import BoundUploadedFile, Upload, UploadSegment
+from ..files import append_segment, segment_chunks, segment_files
+from ..locks import LockError, get_lock
+from ..models import BackgroundHasher, BoundUploadedFile, SegmentedUploadedFile, Upload, UploadBlob, UploadSegment, get_hasher, get_hashers, hash_in_background, hasher_map, is_supported_algorithm, register_hasher
 from ..signals import trigger_materialization
-from ..utils import cache_redis
+from .forms import SegmentedFileForm
 
 
 class SimpleUploadTests(SimpleTestCase):
     def test_db_index_fields(self):
-        for name in ('token', 'user', 'session'):
+        for name in ('token', 'user', 'session', 'status'):
             with self.subTest(name=name):
                 field = Upload._meta.get_field(name)
                 self.assertTrue(field.db_index)
@@ -53,6 +59,31 @@ class UploadTests(TestCase):
         self.assertEqual(count, 0)
         self.assertEqual(Upload.objects.count(), 2)
     
+    @override_settings(UPLOADS_LINGER_DAYS=0)
+    def test_upload_purges_stale_temporary_files(self):
+        path = UploadSegment._meta.get_field('file').storage.path(UploadSegment.upload_to_prefix)
+        os.makedirs(path, exist_ok=True)
+        stale = os.path.join(path, 'tmp1234.upload.txt')
+        kept = os.path.join(path, 'segment.txt')
+        for name in (stale, kept):
+            open(name, 'wb').close()
+        self.addCleanup(os.remove, kept)
+        Upload.purge()
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(os.path.exists(kept))
+    
+    @override_settings(UPLOADS_LINGER_DAYS=0)
+    def test_upload_purges_stale_handoff_links(self):
+        upload = Upload.objects.create(token='some-token', session='some-session')
+        UploadSegment.objects.create(index=1, file=ContentFile('baz', name='baz'), upload=upload)
+        upload.materialize()
+        f = BoundUploadedFile(upload)
+        path = f.temporary_file_path()
+        # as if the process died without closing it
+        f.file.close()
+        Upload.purge()
+        self.assertFalse(os.path.exists(path))
+    
     def test_upload_purges_lingering(self):
         self.assertEqual(Upload.objects.count(), 2)
         self.upload_for_session.lingering = True
@@ -119,8 +150,8 @@ class UploadTests(TestCase):
         )
     
     def test_forced_materialize_is_locked(self):
-        with cache_redis.lock(self.upload_for_session.materialize_lock_key, timeout=60, blocking_timeout=-1) as lock:
-            with self.assertRaises(RedisLockError):
+        with get_lock(self.upload_for_session.materialize_lock_key, 60) as lock:
+            with self.assertRaises(LockError):
                 self.upload_for_session.materialize(force=True)
     
     def test_trigger_lock_key(self):
@@ -133,8 +164,8 @@ class UploadTests(TestCase):
         )
     
     def test_trigger_is_locked(self):
-        with cache_redis.lock(self.upload_for_session.trigger_lock_key, timeout=5, blocking_timeout=-1) as lock:
-            with self.assertRaises(RedisLockError):
+        with get_lock(self.upload_for_session.trigger_lock_key, 5) as lock:
+            with self.assertRaises(LockError):
                 self.upload_for_session.trigger(algorithm='')
     
     def test_materialize_calls_trigger(self):
@@ -142,7 +173,7 @@ class UploadTests(TestCase):
             with self.subTest(algorithm=algo):
                 with patch.object(Upload, 'trigger') as mocked_method:
                     # pre-lock here to confirm no materialization occurs
-                    with cache_redis.lock(self.upload_for_session.materialize_lock_key, timeout=60, blocking_timeout=-1) as lock:
+                    with get_lock(self.upload_for_session.materialize_lock_key, 60) as lock:
                         self.upload_for_session.materialize(algorithm=algo)
                     mocked_method.assert_called_once_with(algo)
     
@@ -176,6 +207,46 @@ class UploadTests(TestCase):
         # verify upload.filename is preferred
         self.assertEqual(f2.name, 'the-updated-name.pdf')
     
+    def test_bound_uploaded_file_is_linked_into_place(self):
+        upload = Upload.objects.create(token='some-token', session='some-session')
+        UploadSegment.objects.create(index=1, file=ContentFile('baz', name='baz'), upload=upload)
+        upload.materialize()
+        f = BoundUploadedFile(upload)
+        path = f.temporary_file_path()
+        self.assertTrue(os.path.samefile(path, upload.file.path))
+        name = default_storage.save('handoff', f)
+        self.addCleanup(default_storage.delete, name)
+        self.assertTrue(os.path.samefile(default_storage.path(name), upload.file.path))
+        self.assertFalse(os.path.exists(path))
+        f.close()
+        self.assertEqual(upload.file.read(), b'baz')
+    
+    def test_bound_uploaded_file_without_local_storage(self):
+        upload = Upload.objects.create(token='some-token', session='some-session')
+        UploadSegment.objects.create(index=1, file=ContentFile('baz', name='baz'), upload=upload)
+        upload.materialize()
+        with patch('segmented_uploads.models.is_local_storage', return_value=False):
+            f = BoundUploadedFile(upload)
+            self.assertIsNone(f.link_path)
+            path = f.temporary_file_path()
+            self.assertFalse(os.path.samefile(path, upload.file.path))
+            self.assertEqual(f.read(), b'baz')
+            f.close()
+        self.assertFalse(os.path.exists(path))
+    
+    def test_bound_uploaded_file_outlives_upload(self):
+        upload = Upload.objects.create(token='some-token', session='some-session')
+        UploadSegment.objects.create(index=1, file=ContentFile('baz', name='baz'), upload=upload)
+        upload.materialize()
+        f = BoundUploadedFile(upload)
+        upload.delete()
+        upload.file.storage.delete(upload.file.name)
+        self.assertFalse(os.path.exists(upload.file.path))
+        self.assertEqual(f.read(), b'baz')
+        path = f.temporary_file_path()
+        f.close()
+        self.assertFalse(os.path.exists(path))
+    
     def test_unmaterialized_upload_uploaded_file(self):
         with self.assertRaises(ValueError):
             self.upload_for_session.uploaded_file
@@ -235,6 +306,292 @@ class UploadTests(TestCase):
                 self.assertEqual(upload.file.read(), b'1,2,3')
                 self.assertEqual(upload.digest, expected)
     
+    def test_materialized_file_content_without_local_storage(self):
+        for algo, expected in (
+            ('', ''),
+            ('md5', '55b84a9d317184fe61224bfb4a060fb0'),
+            ('sha1', 'b85e2d4914e22b5ad3b82b312b3dc405dc17dcb8'),
+        ):
+            with self.subTest(algorithm=algo):
+                upload = Upload.objects.create(token='token-{}-{}'.format(algo, expected), session='session-{}-{}'.format(algo, expected))
+                UploadSegment.objects.create(index=1, file=ContentFile('1,', name='1'), upload=upload)
+                UploadSegment.objects.create(index=3, file=ContentFile('3', name='3'), upload=upload)
+                UploadSegment.objects.create(index=2, file=ContentFile('2,', name='2'), upload=upload)
+                with patch.object(Upload, 'can_materialize_locally', return_value=False):
+                    with patch.object(Upload, 'materialize_locally') as mocked_method:
+                        upload.materialize(algorithm=algo)
+                        mocked_method.assert_not_called()
+                self.assertEqual(upload.file.read(), b'1,2,3')
+                self.assertEqual(upload.digest, expected)
+    
+    @override_settings(UPLOADS_MATERIALIZE_STREAMING=True)
+    def test_materialized_file_content_streaming(self):
+        for algo, expected in (
+            ('', ''),
+            ('md5', '55b84a9d317184fe61224bfb4a060fb0'),
+            ('sha1', 'b85e2d4914e22b5ad3b82b312b3dc405dc17dcb8'),
+        ):
+            with self.subTest(algorithm=algo):
+                upload = Upload.objects.create(token='token-{}-{}'.format(algo, expected), session='session-{}-{}'.format(algo, expected))
+                UploadSegment.objects.create(index=1, file=ContentFile('1,', name='1'), upload=upload)
+                UploadSegment.objects.create(index=3, file=ContentFile('3', name='3'), upload=upload)
+                UploadSegment.objects.create(index=2, file=ContentFile('2,', name='2'), upload=upload)
+                os.makedirs(upload.file.storage.location, exist_ok=True)
+                with patch.object(Upload, 'can_materialize_locally', return_value=False):
+                    with patch.object(Upload, 'get_file_upload_to', side_effect=lambda filename: filename):
+                        with patch('segmented_uploads.models.TemporaryFile') as mocked_class:
+                            upload.materialize(algorithm=algo)
+                            mocked_class.assert_not_called()
+                self.assertEqual(upload.file.read(), b'1,2,3')
+                self.assertEqual(upload.digest, expected)
+                self.assertFalse(upload.segments.exists())
+    
+    @override_settings(UPLOADS_MATERIALIZE_PREFETCH=2, UPLOADS_MATERIALIZE_PREFETCH_BUFFER_SIZE=1)
+    def test_materialized_file_content_with_prefetch(self):
+        upload = Upload.objects.create(token='some-token', session='some-session')
+        for i in range(1, 6):
+            UploadSegment.objects.create(index=i, file=ContentFile('%d,' % i, name=str(i)), upload=upload)
+        with patch.object(Upload, 'can_materialize_locally', return_value=False):
+            with patch('segmented_uploads.models.segment_chunks', wraps=segment_chunks) as mocked_function:
+                upload.materialize(algorithm='md5')
+                mocked_function.assert_called_once_with(MOCK_ANY, prefetch=2, buffer_size=1)
+        self.assertEqual(upload.file.read(), b'1,2,3,4,5,')
+        self.assertEqual(upload.digest, Upload.hexdigest(b'1,2,3,4,5,', algorithm='md5'))
+    
+    @override_settings(UPLOADS_MATERIALIZE_PREFETCH=2)
+    def test_materialize_locally_with_prefetch(self):
+        upload = Upload.objects.create(token='some-token', session='some-session')
+        for i in range(1, 6):
+            UploadSegment.objects.create(index=i, file=ContentFile('%d,' % i, name=str(i)), upload=upload)
+        with patch('segmented_uploads.models.segment_files', wraps=segment_files) as mocked_function:
+            upload.materialize(algorithm='md5')
+            mocked_function.assert_called_once_with(MOCK_ANY, prefetch=2)
+        self.assertEqual(upload.file.read(), b'1,2,3,4,5,')
+        self.assertEqual(upload.digest, Upload.hexdigest(b'1,2,3,4,5,', algorithm='md5'))
+        self.assertFalse(upload.segments.exists())
+    
+    def test_materialize_locally_renames_partial_file(self):
+        upload = Upload.objects.create(token='some-token', session='some-session')
+        UploadSegment.objects.create(index=1, file=ContentFile('1,', name='1'), upload=upload)
+        with patch.object(Upload, 'ensure_partial', autospec=True, side_effect=Upload.ensure_partial) as mocked_method:
+            upload.materialize()
+            mocked_method.assert_called_once_with(upload)
+        self.assertTrue(os.path.exists(upload.file.path))
+        self.assertFalse(upload.partial)
+        upload.refresh_from_db()
+        self.assertFalse(upload.partial)
+    
+    def test_assemble_incrementally(self):
+        upload = Upload.objects.create(token='some-token', session='some-session')
+        UploadSegment.objects.create(index=1, file=ContentFile('1,', name='1'), upload=upload)
+        UploadSegment.objects.create(index=2, file=ContentFile('2,', name='2'), upload=upload)
+        UploadSegment.objects.create(index=4, file=ContentFile('4', name='4'), upload=upload)
+        upload.assemble_incrementally()
+        self.assertEqual(upload.assembled_index, 2)
+        self.assertEqual(upload.assembled_size, 4)
+        self.assertEqual(upload.partial.read(), b'1,2,')
+        
+        first, second, fourth = upload.segments.all()
+        self.assertEqual((first.offset, first.size), (0, 2))
+        self.assertEqual((second.offset, second.size), (2, 2))
+        self.assertFalse(first.file)
+        self.assertFalse(second.file)
+        self.assertFalse(fourth.is_assembled)
+        self.assertTrue(fourth.file)
+        self.assertEqual(second.read(), b'2,')
+        self.assertTrue(second.exists())
+        
+        UploadSegment.objects.create(index=3, file=ContentFile('3,', name='3'), upload=upload)
+        upload.assemble_incrementally()
+        self.assertEqual(upload.assembled_index, 4)
+        self.assertEqual(upload.partial.read(), b'1,2,3,4')
+        
+        upload.materialize(algorithm='md5')
+        self.assertEqual(upload.file.read(), b'1,2,3,4')
+        self.assertEqual(upload.digest, Upload.hexdigest(b'1,2,3,4', algorithm='md5'))
+        self.assertFalse(upload.partial)
+        self.assertFalse(upload.segments.exists())
+    
+    @override_settings(UPLOADS_ASSEMBLY_MODE='incremental')
+    def test_materialize_stale_instance_after_incremental_assembly(self):
+        upload = Upload.objects.create(token='some-token', session='some-session')
+        stale = Upload.objects.get(pk=upload.pk)
+        UploadSegment.objects.create(index=1, file=ContentFile('1,', name='1'), upload=upload)
+        UploadSegment.objects.create(index=2, file=ContentFile('2,', name='2'), upload=upload)
+        upload.assemble_incrementally()
+        partial_name = upload.partial.name
+        UploadSegment.objects.create(index=3, file=ContentFile('3', name='3'), upload=upload)
+        stale.materialize(algorithm='md5')
+        self.assertEqual(stale.file.read(), b'1,2,3')
+        self.assertEqual(stale.digest, Upload.hexdigest(b'1,2,3', algorithm='md5'))
+        self.assertFalse(stale.segments.exists())
+        self.assertFalse(upload.partial.storage.exists(partial_name))
+    
+    def test_materialize_stale_instance_after_materialization(self):
+        upload = Upload.objects.create(token='some-token', session='some-session')
+        stale = Upload.objects.get(pk=upload.pk)
+        UploadSegment.objects.create(index=1, file=ContentFile('1,', name='1'), upload=upload)
+        upload.materialize()
+        with self.assertRaises(SuspiciousOperation):
+            stale.materialize(force=True)
+        self.assertEqual(stale.file.read(), b'1,')
+    
+    def test_assemble_discards_unrecorded_progress(self):
+        upload = Upload.objects.create(token='some-token', session='some-session')
+        UploadSegment.objects.create(index=1, file=ContentFile('1,', name='1'), upload=upload)
+        upload.assemble_incrementally()
+        with upload.partial.open('ab') as f:
+            f.write(b'garbage')
+        UploadSegment.objects.create(index=2, file=ContentFile('2', name='2'), upload=upload)
+        upload.materialize()
+        self.assertEqual(upload.file.read(), b'1,2')
+        
+    def test_materialize_locally_cleans_up_after_error(self):
+        upload = Upload.objects.create(token='some-token', session='some-session')
+        UploadSegment.objects.create(index=1, file=ContentFile('1,', name='1'), upload=upload)
+        paths = []
+        def failing_append_segment(segment, dst_fd, src=None):
+            paths.append(os.readlink('/proc/self/fd/%d' % dst_fd))
+            raise OSError
+        with patch('segmented_uploads.models.append_segment', side_effect=failing_append_segment):
+            with self.assertRaises(OSError):
+                upload.materialize()
+        self.assertFalse(upload.file)
+        self.assertEqual(len(paths), 1)
+        self.assertFalse(os.path.exists(paths[0]))
+        self.assertFalse(upload.partial)
+        upload.refresh_from_db()
+        self.assertEqual(upload.status, Upload.STATUS_FAILED)
+        self.assertTrue(upload.segments.exists())
+    
+    def test_materialize_locally_resumes_after_error(self):
+        upload = Upload.objects.create(token='some-token', session='some-session')
+        for i in range(1, 4):
+            UploadSegment.objects.create(index=i, file=ContentFile('%d,' % i, name=str(i)), upload=upload)
+        calls = []
+        def crashing_append_segment(segment, dst_fd, src=None):
+            calls.append(segment.index)
+            if segment.index == 3 and len(calls) == 3:
+                raise OSError
+            return append_segment(segment, dst_fd, src)
+        with patch('segmented_uploads.models.append_segment', side_effect=crashing_append_segment):
+            with self.assertRaises(OSError):
+                upload.materialize()
+            self.assertFalse(upload.file)
+            self.assertTrue(os.path.exists(upload.partial.path))
+            upload.refresh_from_db()
+            self.assertEqual((upload.assembled_index, upload.assembled_size), (2, 4))
+            upload.materialize(algorithm='md5')
+        self.assertEqual(calls, [1, 2, 3, 3])
+        self.assertEqual(upload.file.read(), b'1,2,3,')
+        self.assertEqual(upload.digest, Upload.hexdigest(b'1,2,3,', algorithm='md5'))
+        self.assertFalse(upload.segments.exists())
+    
+    def test_materialize_status(self):
+        upload = Upload.objects.create(token='some-token', session='some-session')
+        self.assertEqual(upload.status, Upload.STATUS_RECEIVING)
+        UploadSegment.objects.create(index=1, file=ContentFile('1,', name='1'), upload=upload)
+        statuses = []
+        def progress_callback(step, step_count):
+            statuses.append(Upload.objects.get(pk=upload.pk).status)
+        upload.materialize(force=True, progress_callback=progress_callback)
+        self.assertEqual(statuses[0], Upload.STATUS_MATERIALIZING)
+        upload.refresh_from_db()
+        self.assertEqual(upload.status, Upload.STATUS_READY)
+        
+        upload.file.name = ''
+        with self.assertRaisesMessage(SuspiciousOperation, 'already materialized'):
+            upload.materialize()
+    
+    def test_materialize_keeps_segments_until_file_is_saved(self):
+        upload = Upload.objects.create(token='some-token', session='some-session')
+        UploadSegment.objects.create(index=1, file=ContentFile('1,', name='1'), upload=upload)
+        UploadSegment.objects.create(index=2, file=ContentFile('2', name='2'), upload=upload)
+        with patch.object(Upload, 'can_materialize_locally', return_value=False):
+            with patch('django.db.models.fields.files.FieldFile.save', side_effect=OSError):
+                with self.assertRaises(OSError):
+                    upload.materialize()
+        self.assertEqual(upload.segments.count(), 2)
+        upload.refresh_from_db()
+        self.assertEqual(upload.status, Upload.STATUS_FAILED)
+        
+        with patch.object(Upload, 'can_materialize_locally', return_value=False):
+            upload.materialize()
+        self.assertEqual(upload.file.read(), b'1,2')
+        self.assertEqual(upload.status, Upload.STATUS_READY)
+        self.assertFalse(upload.segments.exists())
+    
+    def test_delete_segments_without_returning_keeps_later_segments(self):
+        upload = Upload.objects.create(token='some-token', session='some-session')
+        UploadSegment.objects.create(index=1, file=ContentFile('1,', name='1'), upload=upload)
+        UploadSegment.objects.create(index=2, file=ContentFile('2', name='2'), upload=upload)
+        values_list = QuerySet.values_list
+        def receive_after_read(queryset, *fields, **kwargs):
+            rows = list(values_list(queryset, *fields, **kwargs))
+            UploadSegment.objects.create(index=3, file=ContentFile('3', name='3'), upload=upload)
+            return rows
+        with patch('segmented_uploads.models.supports_returning', return_value=False):
+            with patch.object(QuerySet, 'values_list', autospec=True, side_effect=receive_after_read):
+                upload.delete_segments()
+        self.assertEqual(list(upload.segments.values_list('index', flat=True)), [3])
+    
+    def test_open_segments(self):
+        upload = Upload.objects.create(token='some-token', session='some-session', filename='name.txt')
+        UploadSegment.objects.create(index=1, file=ContentFile('one,', name='1'), upload=upload)
+        UploadSegment.objects.create(index=3, file=ContentFile('three', name='3'), upload=upload)
+        UploadSegment.objects.create(index=2, file=ContentFile('two,', name='2'), upload=upload)
+        with upload.open_segments() as f:
+            self.assertIsInstance(f, SegmentedUploadedFile)
+            self.assertEqual(f.name, 'name.txt')
+            self.assertEqual(f.size, 13)
+            self.assertEqual(b''.join(f.chunks(chunk_size=3)), b'one,two,three')
+        self.assertFalse(upload.file)
+        self.assertEqual(upload.segments.count(), 3)
+    
+    def test_open_segments_partially_assembled(self):
+        upload = Upload.objects.create(token='some-token', session='some-session')
+        UploadSegment.objects.create(index=1, file=ContentFile('one,', name='1'), upload=upload)
+        UploadSegment.objects.create(index=3, file=ContentFile('three', name='3'), upload=upload)
+        upload.assemble_incrementally()
+        UploadSegment.objects.create(index=2, file=ContentFile('two,', name='2'), upload=upload)
+        with upload.open_segments() as f:
+            self.assertEqual(f.read(), b'one,two,three')
+        upload.partial.delete()
+    
+    @override_settings(UPLOADS_MATERIALIZE_LAZILY=True)
+    def test_materialize_lazily(self):
+        upload = Upload.objects.create(token='some-token', session='some-session')
+        UploadSegment.objects.create(index=1, file=ContentFile('one,', name='1'), upload=upload)
+        UploadSegment.objects.create(index=2, file=ContentFile('two', name='2'), upload=upload)
+        upload.materialize(algorithm='md5')
+        self.assertFalse(upload.file)
+        self.assertTrue(upload.lazy)
+        self.assertTrue(upload.is_materialized)
+        self.assertEqual(upload.status, Upload.STATUS_READY)
+        self.assertTrue(Upload.objects.get(pk=upload.pk).is_materialized)
+        self.assertEqual(upload.digest, Upload.hexdigest(b'one,two', algorithm='md5'))
+        self.assertEqual(upload.segments.count(), 2)
+        self.assertIsInstance(upload.uploaded_file, SegmentedUploadedFile)
+        self.assertEqual(upload.uploaded_file.read(), b'one,two')
+        
+        form = SegmentedFileForm(files={'file': upload.uploaded_file})
+        self.assertTrue(form.is_valid())
+        
+        with self.assertRaisesMessage(SuspiciousOperation, 'already materialized'):
+            upload.materialize()
+    
+    def test_materialize_records_segment_digests(self):
+        upload = Upload.objects.create(token='some-token', session='some-session')
+        UploadSegment.objects.create(index=1, file=ContentFile('one,', name='1'), upload=upload, size=4, digest_algorithm='md5', digest=Upload.hexdigest(b'one,', algorithm='md5'))
+        UploadSegment.objects.create(index=2, file=ContentFile('two', name='2'), upload=upload, size=3, digest_algorithm='md5', digest=Upload.hexdigest(b'two', algorithm='md5'))
+        upload.materialize()
+        self.assertFalse(upload.segments.exists())
+        digest = Upload.hexdigest(b'two', algorithm='md5')
+        self.assertEqual(upload.read_segment('md5', digest, 3), (b'two', {'md5': digest}))
+        self.assertIsNone(upload.read_segment('md5', digest, 2))
+        self.assertIsNone(upload.read_segment('sha1', digest, 3))
+        upload.file.delete()
+    
     def test_uploaded_file_content(self):
         upload = Upload.objects.create(token='some-token', session='some-session')
         UploadSegment.objects.create(index=1, file=ContentFile('one,', name='1'), upload=upload)
@@ -243,17 +600,75 @@ class UploadTests(TestCase):
         upload.materialize()
         self.assertEqual(upload.uploaded_file.read(), b'one,two,three')
     
+    def test_register_hasher(self):
+        self.assertFalse(is_supported_algorithm('sha3_256'))
+        self.addCleanup(hasher_map.pop, 'sha3_256')
+        register_hasher('sha3_256', sha3_256)
+        self.assertTrue(is_supported_algorithm('sha3_256'))
+        self.assertTrue(is_supported_algorithm('tree-sha3_256'))
+        self.assertEqual(Upload.hexdigest(b'data', algorithm='sha3_256'), sha3_256(b'data').hexdigest())
+    
+    def test_materialize_tree_digest(self):
+        upload = Upload.objects.create(token='some-token', session='some-session')
+        digests = [Upload.hexdigest(data, algorithm='md5') for data in (b'one,', b'two,', b'three')]
+        UploadSegment.objects.create(index=1, file=ContentFile('one,', name='1'), upload=upload, digest_algorithm='md5', digest=digests[0])
+        UploadSegment.objects.create(index=2, file=ContentFile('two,', name='2'), upload=upload, digest_algorithm='md5', digest=digests[1])
+        # segments without a stored digest are read instead
+        UploadSegment.objects.create(index=3, file=ContentFile('three', name='3'), upload=upload)
+        with patch.object(UploadSegment, 'read', autospec=True, side_effect=UploadSegment.read) as mocked_method:
+            upload.materialize(algorithm='tree-md5')
+            self.assertEqual([args[0].index for args, kwargs in mocked_method.call_args_list], [3])
+        self.assertEqual(upload.digest, Upload.hexdigest(''.join(digests), algorithm='md5'))
+        self.assertEqual(upload.digest_algorithm, 'tree-md5')
+        self.assertEqual(upload.file.read(), b'one,two,three')
+    
     def test_digest_algorithms(self):
         for algo, expected in (
             # expected is the algorithm's hexdigest for an empty string
             ('', ''),
             ('md5', 'd41d8cd98f00b204e9800998ecf8427e'),
             ('sha1', 'da39a3ee5e6b4b0d3255bfef95601890afd80709'),
+            ('sha256', 'e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855'),
+            ('sha512', 'cf83e1357eefb8bdf1542850d66d8007d620e4050b5715dc83f4a921d36ce9ce47d0d13c5d85f2b0ff8318d2877eec2f63b931bd47417a81a538327af927da3e'),
+            ('blake2b', '786a02f742015903c6c6fd852552d272912f4740e15847618a86e217f71f5419d25e1031afee585313896444934eb04b903a685b1448b755d56f701afe9be2ce'),
         ):
             with self.subTest(algorithm=algo):
                 upload = Upload.objects.create(token=algo, session=algo)
                 upload.materialize(algorithm=algo)
                 self.assertEqual(upload.digest, expected)
+    
+    @override_settings(UPLOADS_DIGEST_ALGORITHMS=['sha256', 'unknown'])
+    def test_materialize_computes_further_digests(self):
+        upload = Upload.objects.create(token='some-token', session='some-session')
+        UploadSegment.objects.create(index=1, file=ContentFile('one,', name='1'), upload=upload)
+        UploadSegment.objects.create(index=2, file=ContentFile('two', name='2'), upload=upload)
+        upload.materialize(algorithm='md5')
+        self.assertEqual(upload.digest, Upload.hexdigest(b'one,two', algorithm='md5'))
+        self.assertEqual(upload.get_digests(), {
+            'md5': Upload.hexdigest(b'one,two', algorithm='md5'),
+            'sha256': Upload.hexdigest(b'one,two', algorithm='sha256'),
+        })
+    
+    @override_settings(UPLOADS_DIGEST_ALGORITHMS=['sha256'])
+    def test_hash_in_background(self):
+        hasher = hash_in_background(get_hashers('md5'), buffers=2)
+        self.assertTrue(all(isinstance(h, BackgroundHasher) for h in hasher.hashers.values()))
+        for chunk in (b'one,', b'two,', b'three'):
+            hasher.update(chunk)
+        self.assertEqual(hasher.hexdigest(), Upload.hexdigest(b'one,two,three', algorithm='md5'))
+        self.assertEqual(hasher.hexdigests()['sha256'], Upload.hexdigest(b'one,two,three', algorithm='sha256'))
+        # nothing to do in the background without a real hasher
+        self.assertIs(hash_in_background(get_hasher(''), buffers=2), get_hasher(''))
+    
+    @override_settings(UPLOADS_HASH_BUFFERS=2)
+    def test_materialize_hashes_in_background(self):
+        upload = Upload.objects.create(token='some-token', session='some-session')
+        UploadSegment.objects.create(index=1, file=ContentFile('one,', name='1'), upload=upload)
+        segment = UploadSegment.objects.create(index=2, file=ContentFile('two', name='2'), upload=upload)
+        self.assertEqual(segment.get_digest('md5'), Upload.hexdigest(b'two', algorithm='md5'))
+        upload.materialize(algorithm='md5')
+        self.assertEqual(upload.digest, Upload.hexdigest(b'one,two', algorithm='md5'))
+        self.assertEqual(upload.file.read(), b'one,two')
 
 
 class UploadTransactionTests(TransactionTestCase):
@@ -277,3 +692,114 @@ class UploadTransactionTests(TransactionTestCase):
                 storage.exists(name),
                 'file should not be removed before the transaction is committed')
         self.assertFalse(storage.exists(name))
+    
+    def test_materialize_does_not_hold_a_transaction(self):
+        upload = Upload.objects.create(token='some-token', session='some-session')
+        UploadSegment.objects.create(index=1, file=ContentFile('1,', name='1'), upload=upload)
+        in_atomic_block = []
+        def progress_callback(step, step_count):
+            in_atomic_block.append(transaction.get_connection().in_atomic_block)
+        upload.materialize(force=True, progress_callback=progress_callback)
+        self.assertEqual(in_atomic_block, [False, False])
+        self.assertEqual(upload.status, Upload.STATUS_READY)
+    
+    def test_materialize_deletes_segments_in_bulk(self):
+        upload = Upload.objects.create(token='some-token', session='some-session')
+        segments = [
+            UploadSegment.objects.create(index=i, file=ContentFile('%d,' % i, name=str(i)), upload=upload)
+            for i in range(1, 4)
+        ]
+        storage = segments[0].file.storage
+        deleted = []
+        def receiver(sender, instance, **kwargs):
+            deleted.append(instance)
+        post_delete.connect(receiver, sender=UploadSegment)
+        self.addCleanup(post_delete.disconnect, receiver, sender=UploadSegment)
+        with patch.object(Upload, 'can_materialize_locally', return_value=False):
+            with transaction.atomic():
+                upload.materialize(force=True)
+                self.assertFalse(upload.segments.exists())
+                for segment in segments:
+                    self.assertTrue(
+                        storage.exists(segment.file.name),
+                        'segment files should not be removed before the transaction is committed')
+        self.assertEqual(deleted, [])
+        for segment in segments:
+            self.assertFalse(storage.exists(segment.file.name))
+        upload.file.delete()
+    
+    @override_settings(UPLOADS_DEDUPLICATE=True)
+    def test_materialize_deduplicates_by_strong_digest(self):
+        # a file planted under the md5 digest of other content, as a collision
+        # would, is never shared
+        planted = UploadBlob.objects.create(
+            algorithm='md5',
+            digest=Upload.hexdigest(b'1,2', algorithm='md5'),
+            size=3,
+            file=ContentFile(b'bad', name='bad'),
+            reference_count=1,
+        )
+        self.addCleanup(planted.file.delete, False)
+        upload = Upload.objects.create(token='some-token', session='some-session')
+        UploadSegment.objects.create(index=1, file=ContentFile('1,', name='1'), upload=upload)
+        UploadSegment.objects.create(index=2, file=ContentFile('2', name='2'), upload=upload)
+        upload.materialize(algorithm='md5')
+        self.assertNotEqual(upload.blob, planted)
+        self.assertEqual(upload.blob.algorithm, 'sha256')
+        self.assertEqual(upload.file.read(), b'1,2')
+        upload.delete()
+    
+    @override_settings(UPLOADS_DEDUPLICATE=True)
+    def test_materialize_deduplicates(self):
+        uploads = []
+        for i in range(3):
+            upload = Upload.objects.create(token='token-%d' % i, session='some-session')
+            UploadSegment.objects.create(index=1, file=ContentFile('1,', name='1'), upload=upload)
+            UploadSegment.objects.create(index=2, file=ContentFile('2' if i < 2 else '3', name='2'), upload=upload)
+            uploads.append(upload)
+        uploads[0].materialize(algorithm='md5')
+        with patch.object(Upload, 'materialize_locally') as mocked_method:
+            uploads[1].materialize(algorithm='md5')
+            mocked_method.assert_not_called()
+        uploads[2].materialize(algorithm='md5')
+        
+        first, second, other = uploads
+        self.assertEqual(second.file.name, first.file.name)
+        self.assertEqual(second.blob, first.blob)
+        self.assertNotEqual(other.blob, first.blob)
+        self.assertEqual(second.digest, Upload.hexdigest(b'1,2', algorithm='md5'))
+        self.assertEqual(second.file.read(), b'1,2')
+        self.assertFalse(second.segments.exists())
+        blob = UploadBlob.objects.get(pk=first.blob_id)
+        self.assertEqual((blob.algorithm, blob.digest, blob.size, blob.reference_count), ('sha256', Upload.hexdigest(b'1,2', algorithm='sha256'), 3, 2))
+        
+        name = first.file.name
+        storage = first.file.storage
+        first.delete()
+        self.assertTrue(storage.exists(name))
+        self.assertEqual(UploadBlob.objects.get(pk=blob.pk).reference_count, 1)
+        second.delete()
+        self.assertFalse(storage.exists(name))
+        self.assertFalse(UploadBlob.objects.filter(pk=blob.pk).exists())
+        other.delete()
+    
+    @override_settings(UPLOADS_DEDUPLICATE=True)
+    def test_materialize_deduplicates_without_algorithm(self):
+        uploads = []
+        for i in range(2):
+            upload = Upload.objects.create(token='token-%d' % i, session='some-session')
+            UploadSegment.objects.create(index=1, file=ContentFile('1,', name='1'), upload=upload)
+            UploadSegment.objects.create(index=2, file=ContentFile('2', name='2'), upload=upload)
+            uploads.append(upload)
+        uploads[0].materialize()
+        with patch.object(Upload, 'materialize_locally') as mocked_method:
+            uploads[1].materialize()
+            mocked_method.assert_not_called()
+        first, second = uploads
+        self.assertEqual(second.blob, first.blob)
+        self.assertEqual(second.file.name, first.file.name)
+        self.assertEqual(second.file.read(), b'1,2')
+        self.assertFalse(second.digest)
+        self.assertEqual(UploadBlob.objects.get(pk=first.blob_id).reference_count, 2)
+        first.delete()
+        second.delete()
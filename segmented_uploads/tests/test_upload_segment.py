@@ -1,3 +1,5 @@
+from unittest.mock import patch
+
 from django.core.files.base import ContentFile
 from django.db import transaction
 from django.test import TestCase, TransactionTestCase
@@ -28,6 +30,25 @@ class UploadSegmentTests(TestCase):
             with self.subTest(algorithm=algo):
                 self.assertEqual(self.segment.get_digest(algorithm=algo), expected)
     
+    def test_get_digest_prefers_stored_digest(self):
+        self.segment.digest_algorithm = 'md5'
+        self.segment.digest = 'stored-digest'
+        with patch.object(UploadSegment, 'read') as mocked_method:
+            self.assertEqual(self.segment.get_digest(algorithm='md5'), 'stored-digest')
+            mocked_method.assert_not_called()
+        self.assertEqual(self.segment.get_digest(algorithm='sha1'), '94e66df8cd09d410c62d9e0dc59d3a884e458e05')
+    
+    def test_hash_uploaded_file(self):
+        for algo, expected in (
+            ('', ''),
+            ('md5', '9893532233caff98cd083a116b013c0b'),
+            ('unknown', ''),
+        ):
+            with self.subTest(algorithm=algo):
+                self.segment.hash_uploaded_file(ContentFile(b'some content'), algorithm=algo)
+                self.assertEqual(self.segment.digest, expected)
+                self.assertEqual(self.segment.digest_algorithm, algo if expected else '')
+    
     def test_get_digest_missing_file_on_storage(self):
         self.assertTrue(self.segment.file)
         self.assertTrue(self.segment.file.name)
@@ -1,16 +1,22 @@
+import os
 from io import BytesIO
 from os.path import basename
 from unittest.mock import patch
+from urllib.parse import urlencode
 from uuid import uuid4
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.exceptions import NON_FIELD_ERRORS
 from django.core.files.base import ContentFile
 from django.db import models
-from django.test import TestCase
+from django.test import Client, SimpleTestCase, TestCase, override_settings
 from django.urls import reverse
 from django.utils.encoding import force_bytes
 
-from ..models import Upload, UploadSegment
+from ..models import Upload, UploadSegment, get_hashers
+from ..handlers import receive_raw_segment
+from ..views import SEGMENT_LIMIT, get_index_ranges
 
 
 class BaseUploadViewTests(TestCase):
@@ -59,6 +65,74 @@ class CommonTestsMixin(object):
         response = self.client.get(self.endpoint, {'identifier': self.identifier, 'index': 2})
         self.assertEqual(response.status_code, 204)
     
+    def test_post_segment_query_count(self):
+        # session, user or session check, upload, segment upsert and file update
+        for data in (b'first', b'second'):
+            with self.assertNumQueries(5):
+                response = self.client.post(self.endpoint, {'identifier': self.identifier, 'index': 1, 'file': BytesIO(data)})
+            self.assertEqual(response.status_code, 200)
+        segment = self.upload.segments.get()
+        self.assertEqual(segment.attempt_count, 2)
+        self.assertEqual(segment.file.read(), b'second')
+    
+    def test_post_segment_index_out_of_range(self):
+        for index in (0, SEGMENT_LIMIT + 1):
+            with self.subTest(index=index):
+                response = self.client.post(self.endpoint, {'identifier': self.identifier, 'index': index, 'file': BytesIO(b'data')})
+                self.assertEqual(response.status_code, 500)
+                self.assertIn('too many segments', response.json()['errors'][NON_FIELD_ERRORS][0])
+        self.assertFalse(self.upload.segments.filter(index__in=[0, SEGMENT_LIMIT + 1]).exists())
+    
+    def test_get_manifest(self):
+        UploadSegment.objects.create(index=2, file=ContentFile(b'two', name='segment'), upload=self.upload, digest_algorithm='md5', digest='two-digest')
+        UploadSegment.objects.create(index=4, offset=0, size=4, upload=self.upload)
+        UploadSegment.objects.create(index=5, upload=self.upload)
+        UploadSegment.objects.create(index=6, file=ContentFile(b'six', name='segment'), upload=self.upload)
+        # session, user or session check, upload and a single query for every segment
+        with self.assertNumQueries(4), patch('django.core.files.storage.FileSystemStorage.exists') as mocked_method:
+            response = self.client.get(self.endpoint, {'identifier': self.identifier, 'manifest': 1})
+            mocked_method.assert_not_called()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {
+            'materialized': False,
+            'received': [[1, 2], [4, 4], [6, 6]],
+            'digests': {'2': {'md5': 'two-digest'}},
+        })
+    
+    def test_options(self):
+        response = self.client.options(self.endpoint)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['validation']['segment_limit'], SEGMENT_LIMIT)
+        self.assertIn('blake2b', response.json()['validation']['algorithms'])
+        self.assertIn('tree-sha256', response.json()['validation']['algorithms'])
+        self.assertIs(response.json()['validation']['deduplicate'], False)
+        with self.settings(UPLOADS_DEDUPLICATE=True):
+            response = self.client.options(self.endpoint)
+            self.assertIs(response.json()['validation']['deduplicate'], True)
+    
+    def test_resume_materialized_upload(self):
+        digest = Upload.hexdigest(self.segment_data, algorithm='md5')
+        response = self.client.post(self.endpoint, {'identifier': self.identifier, 'algorithm': 'md5', 'digest': digest})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content)
+        
+        # a client resuming the upload learns it has nothing left to send
+        response = self.client.get(self.endpoint, {'identifier': self.identifier, 'manifest': 1})
+        self.assertEqual(response.json(), {'materialized': True, 'received': [], 'digests': {}})
+        response = self.client.post(self.endpoint, {'identifier': self.identifier, 'index': 1, 'file': BytesIO(self.segment_data)})
+        self.assertEqual(response.status_code, 409)
+        
+        # and finalizing again answers with a new secret
+        response = self.client.post(self.endpoint, {'identifier': self.identifier, 'algorithm': 'md5', 'digest': digest})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content)
+        self.assertEqual(self.get_upload(self.identifier).secrets.count(), 2)
+    
+    def test_get_manifest_unknown_identifier(self):
+        response = self.client.get(self.endpoint, {'identifier': 'unknown', 'manifest': 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'materialized': False, 'received': [], 'digests': {}})
+    
     def test_post_segment(self):
         alt_data = force_bytes('unknown-content-{}'.format(uuid4()))
         response = self.client.post(self.endpoint, {'identifier': 'unknown', 'index': 1, 'file': BytesIO(alt_data), 'filename': 'unknown.txt'})
@@ -157,6 +231,97 @@ class CommonTestsMixin(object):
         self.assertEqual(segment.file.read(), alt_data)
         self.assertNotEqual(segment.file.name, first_file_name)
     
+    def test_post_segment_stores_digest(self):
+        data = b'abc123'
+        digest = Upload.hexdigest(data, algorithm='md5')
+        response = self.client.post(self.endpoint, {'identifier': 'abc', 'index': 1, 'file': BytesIO(data), 'digest': digest, 'algorithm': 'md5'})
+        self.assertEqual(response.status_code, 200)
+        
+        segment = self.get_upload('abc').segments.get()
+        self.assertEqual(segment.digest_algorithm, 'md5')
+        self.assertEqual(segment.digest, digest)
+        
+        with patch.object(UploadSegment, 'read') as mocked_method:
+            response = self.client.get(self.endpoint, {'identifier': 'abc', 'index': 1, 'digest': digest, 'algorithm': 'md5'})
+            self.assertEqual(response.status_code, 200)
+            response = self.client.post(self.endpoint, {'identifier': 'abc', 'index': 1, 'file': BytesIO(data), 'digest': digest, 'algorithm': 'md5'})
+            self.assertEqual(response.status_code, 200)
+            mocked_method.assert_not_called()
+    
+    def test_post_segment_is_hashed_while_received(self):
+        data = b'abc123'
+        digest = Upload.hexdigest(data, algorithm='md5')
+        with patch('segmented_uploads.handlers.get_hashers', wraps=get_hashers) as mocked_function, \
+                patch.object(UploadSegment, 'get_digest') as mocked_get_digest, \
+                patch.object(UploadSegment, 'read') as mocked_read, \
+                patch.object(UploadSegment, 'chunks') as mocked_chunks:
+            response = self.client.post(self.endpoint + '?algorithm=md5', {'identifier': 'abc', 'index': 1, 'file': BytesIO(data), 'digest': digest})
+            self.assertEqual(response.status_code, 200)
+            # the hasher is built once by the upload handler and its digest is
+            # used as is, without reading the segment back
+            mocked_function.assert_called_once_with('md5')
+            mocked_get_digest.assert_not_called()
+            mocked_read.assert_not_called()
+            mocked_chunks.assert_not_called()
+        
+        segment = self.get_upload('abc').segments.get()
+        self.assertEqual(segment.digest_algorithm, 'md5')
+        self.assertEqual(segment.digest, digest)
+    
+    @override_settings(MIDDLEWARE=settings.MIDDLEWARE + ['django.middleware.csrf.CsrfViewMiddleware'])
+    def test_post_segment_requires_csrf_token(self):
+        client = Client(enforce_csrf_checks=True)
+        client.cookies = self.client.cookies
+        response = client.post(self.endpoint, {'identifier': 'abc', 'index': 1, 'file': BytesIO(b'abc123')})
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(UploadSegment.objects.filter(upload__token=Upload.hexdigest('abc')).exists())
+    
+    def test_post_segment_without_csrf_middleware(self):
+        client = Client(enforce_csrf_checks=True)
+        client.cookies = self.client.cookies
+        response = client.post(self.endpoint, {'identifier': 'abc', 'index': 1, 'file': BytesIO(b'abc123')})
+        self.assertEqual(response.status_code, 200)
+    
+    def test_patch_raw_segment(self):
+        data = b'raw segment content'
+        digest = Upload.hexdigest(data, algorithm='md5')
+        query = urlencode({'identifier': 'raw', 'index': 1, 'algorithm': 'md5', 'digest': digest, 'filename': 'raw.txt'})
+        received = []
+        def receive(request):
+            received.append(receive_raw_segment(request))
+            return received[-1]
+        with patch('segmented_uploads.views.receive_raw_segment', side_effect=receive):
+            response = self.client.patch('%s?%s' % (self.endpoint, query), data, content_type='application/octet-stream')
+            self.assertEqual(response.status_code, 200)
+        # closed along with the request rather than when it is collected
+        self.assertTrue(received[0].closed)
+        
+        segment = self.get_upload('raw').segments.get()
+        self.assertEqual(segment.index, 1)
+        self.assertEqual(segment.file.read(), data)
+        self.assertEqual(segment.digest, digest)
+        self.assertTrue(segment.file.name.endswith('raw.txt'))
+    
+    def test_patch_raw_segment_digest_mismatch(self):
+        query = urlencode({'identifier': 'raw', 'index': 1, 'algorithm': 'md5', 'digest': 'no-match'})
+        response = self.client.patch('%s?%s' % (self.endpoint, query), b'raw segment content', content_type='application/octet-stream')
+        self.assertEqual(response.status_code, 400)
+    
+    def test_patch_requires_index(self):
+        query = urlencode({'identifier': self.identifier})
+        with patch.object(Upload, 'materialize') as mocked_method:
+            response = self.client.patch('%s?%s' % (self.endpoint, query), b'', content_type='application/octet-stream')
+            mocked_method.assert_not_called()
+        self.assertEqual(response.status_code, 500)
+    
+    def test_patch_raw_segment_too_large(self):
+        with patch('segmented_uploads.views.SEGMENT_ALLOWABLE_SIZE', 4):
+            query = urlencode({'identifier': 'raw', 'index': 1})
+            with patch('segmented_uploads.views.receive_raw_segment') as mocked_function:
+                response = self.client.patch('%s?%s' % (self.endpoint, query), b'12345', content_type='application/octet-stream')
+                mocked_function.assert_not_called()
+        self.assertEqual(response.status_code, 500)
+    
     def test_duplicate_segment_post_with_digest_keeps_file(self):
         alt_data = force_bytes('abc123')
         alt_file = BytesIO(alt_data)
@@ -193,6 +358,167 @@ class CommonTestsMixin(object):
         self.assertEqual(segment.file.read(), alt_data)
         self.assertEqual(segment.file.name, first_file_name)
     
+    @override_settings(UPLOADS_ASSEMBLY_MODE='incremental')
+    def test_post_segment_assembles_incrementally(self):
+        response = self.client.post(self.endpoint, {'identifier': self.identifier, 'index': 2, 'file': BytesIO(b'two')})
+        self.assertEqual(response.status_code, 200)
+        
+        self.upload.refresh_from_db()
+        self.assertEqual(self.upload.assembled_index, 2)
+        self.assertEqual(self.upload.partial.read(), self.segment_data + b'two')
+        
+        digest = Upload.hexdigest(self.segment_data, algorithm='md5')
+        for params, status_code in (
+            ({}, 200),
+            ({'digest': digest, 'algorithm': 'md5'}, 200),
+            ({'digest': 'no-match', 'algorithm': 'md5'}, 204),
+        ):
+            with self.subTest(params=params):
+                response = self.client.get(self.endpoint, dict(params, identifier=self.identifier, index=1))
+                self.assertEqual(response.status_code, status_code)
+        
+        response = self.client.post(self.endpoint, {'identifier': self.identifier, 'index': 2, 'file': BytesIO(b'TWO')})
+        self.assertEqual(response.status_code, 200)
+        self.upload.refresh_from_db()
+        self.assertEqual(self.upload.partial.read(), self.segment_data + b'TWO')
+        
+        response = self.client.post(self.endpoint, {'identifier': self.identifier, 'index': 2, 'file': BytesIO(b'three')})
+        self.assertEqual(response.status_code, 500)
+        self.upload.refresh_from_db()
+        self.assertEqual(self.upload.partial.read(), self.segment_data + b'TWO')
+    
+    @override_settings(UPLOADS_ASSEMBLY_MODE='offset')
+    def test_post_segment_at_offset(self):
+        params = {'identifier': 'offset', 'chunk_size': 3, 'total_size': 7}
+        for index, data in ((3, b'g'), (1, b'abc'), (2, b'def')):
+            response = self.client.post(self.endpoint, dict(params, index=index, file=BytesIO(data)))
+            self.assertEqual(response.status_code, 200)
+        
+        upload = self.get_upload('offset')
+        self.assertEqual((upload.size, upload.chunk_size), (7, 3))
+        self.assertEqual(upload.partial.read(), b'abcdefg')
+        for segment in upload.segments.all():
+            with self.subTest(index=segment.index):
+                self.assertFalse(segment.file)
+                self.assertEqual(segment.offset, (segment.index - 1) * 3)
+        
+        response = self.client.get(self.endpoint, {'identifier': 'offset', 'index': 2, 'algorithm': 'md5', 'digest': Upload.hexdigest(b'def', algorithm='md5')})
+        self.assertEqual(response.status_code, 200)
+        
+        response = self.client.post(self.endpoint, {'identifier': 'offset', 'algorithm': 'md5', 'digest': Upload.hexdigest(b'abcdefg', algorithm='md5')})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content)
+        upload.refresh_from_db()
+        self.assertEqual(upload.file.read(), b'abcdefg')
+        self.assertFalse(upload.partial)
+    
+    @override_settings(UPLOADS_ASSEMBLY_MODE='offset')
+    def test_post_segment_at_offset_must_fit(self):
+        params = {'identifier': 'offset', 'chunk_size': 3, 'total_size': 7}
+        for index, data in ((1, b'ab'), (3, b'gh'), (4, b'g')):
+            with self.subTest(index=index):
+                response = self.client.post(self.endpoint, dict(params, index=index, file=BytesIO(data)))
+                self.assertEqual(response.status_code, 500)
+        response = self.client.post(self.endpoint, dict(params, total_size=8, index=1, file=BytesIO(b'abc')))
+        self.assertEqual(response.status_code, 500)
+    
+    @override_settings(UPLOADS_ASSEMBLY_MODE='offset')
+    def test_post_segment_at_offset_invalid_size(self):
+        for params in ({'total_size': -1}, {'total_size': 0}, {'total_size': 7, 'chunk_size': -3}):
+            with self.subTest(**params):
+                response = self.client.post(self.endpoint, dict(params, identifier='offset', index=1, file=BytesIO(b'abc')))
+                self.assertEqual(response.status_code, 400)
+        self.assertFalse(self.get_upload('offset').partial)
+    
+    @override_settings(UPLOADS_ASSEMBLY_MODE='offset')
+    def test_post_segment_at_offset_is_sparse(self):
+        params = {'identifier': 'offset', 'chunk_size': 3, 'total_size': 8 * 1024 * 1024}
+        response = self.client.post(self.endpoint, dict(params, index=1, file=BytesIO(b'abc')))
+        self.assertEqual(response.status_code, 200)
+        stat = os.stat(self.get_upload('offset').partial.path)
+        self.assertEqual(stat.st_size, 8 * 1024 * 1024)
+        self.assertLess(stat.st_blocks * 512, 1024 * 1024)
+    
+    def test_post_reused_segment(self):
+        data = b'segment of an earlier version'
+        digest = Upload.hexdigest(data, algorithm='md5')
+        response = self.client.post(self.endpoint, {'identifier': 'earlier', 'index': 1, 'file': BytesIO(data), 'algorithm': 'md5', 'digest': digest})
+        self.assertEqual(response.status_code, 200)
+        original = self.get_upload('earlier').segments.get(index=1)
+        
+        params = {'identifier': 'edited', 'index': 2, 'algorithm': 'md5', 'digest': digest, 'segment_size': len(data), 'reuse': 1}
+        response = self.client.post(self.endpoint, dict(params, digest=Upload.hexdigest(b'changed', algorithm='md5')))
+        self.assertEqual(response.status_code, 204)
+        response = self.client.post(self.endpoint, dict(params, segment_size=len(data) - 1))
+        self.assertEqual(response.status_code, 204)
+        response = self.client.post(self.endpoint, params)
+        self.assertEqual(response.status_code, 200)
+        
+        segment = self.get_upload('edited').segments.get(index=2)
+        self.assertNotEqual(segment.file.name, original.file.name)
+        self.assertEqual(segment.read(), data)
+        self.assertEqual((segment.digest_algorithm, segment.digest, segment.size), ('md5', digest, len(data)))
+    
+    def test_post_segment_reused_from_materialized_upload(self):
+        segments = [b'first segment,', b'second segment']
+        for index, data in enumerate(segments, start=1):
+            response = self.client.post(self.endpoint, {'identifier': 'earlier', 'index': index, 'file': BytesIO(data), 'algorithm': 'md5', 'digest': Upload.hexdigest(data, algorithm='md5')})
+            self.assertEqual(response.status_code, 200)
+        response = self.client.post(self.endpoint, {'identifier': 'earlier', 'algorithm': 'md5', 'digest': Upload.hexdigest(b''.join(segments), algorithm='md5')})
+        self.assertEqual(response.status_code, 200)
+        earlier = self.get_upload('earlier')
+        self.assertTrue(earlier.file)
+        self.assertFalse(earlier.segments.exists())
+        
+        data = segments[1]
+        digest = Upload.hexdigest(data, algorithm='md5')
+        params = {'identifier': 'edited', 'index': 2, 'algorithm': 'md5', 'digest': digest, 'segment_size': len(data), 'reuse': 1}
+        response = self.client.post(self.endpoint, dict(params, segment_size=len(data) - 1))
+        self.assertEqual(response.status_code, 204)
+        response = self.client.post(self.endpoint, params)
+        self.assertEqual(response.status_code, 200)
+        
+        segment = self.get_upload('edited').segments.get(index=2)
+        self.assertEqual(segment.read(), data)
+        self.assertEqual((segment.digest_algorithm, segment.digest, segment.size), ('md5', digest, len(data)))
+    
+    def test_post_instant_without_deduplication(self):
+        params = {'identifier': 'instant', 'algorithm': 'md5', 'digest': Upload.hexdigest(b'data', algorithm='md5'), 'total_size': 4, 'instant': 1}
+        response = self.client.post(self.endpoint, params)
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(Upload.objects.filter(token=Upload.hexdigest('instant')).exists())
+    
+    @override_settings(UPLOADS_DEDUPLICATE=True)
+    def test_post_instant(self):
+        data = b'content the server already has'
+        digest = Upload.hexdigest(data, algorithm='md5')
+        params = {'identifier': 'instant', 'algorithm': 'md5', 'digest': digest, 'total_size': len(data), 'instant': 1}
+        response = self.client.post(self.endpoint, params)
+        self.assertEqual(response.status_code, 204)
+        
+        response = self.client.post(self.endpoint, {'identifier': 'original', 'index': 1, 'file': BytesIO(data)})
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post(self.endpoint, {'identifier': 'original', 'algorithm': 'md5', 'digest': digest})
+        self.assertEqual(response.status_code, 200)
+        
+        response = self.client.post(self.endpoint, dict(params, total_size=len(data) + 1))
+        self.assertEqual(response.status_code, 204)
+        response = self.client.post(self.endpoint, params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content)
+        
+        upload = self.get_upload('instant')
+        self.assertEqual(upload.blob_id, self.get_upload('original').blob_id)
+        self.assertEqual(upload.status, Upload.STATUS_READY)
+        self.assertFalse(upload.segments.exists())
+        self.assertEqual(upload.file.read(), data)
+        
+        # the digest is the client's word, so files of others never match
+        client = Client()
+        client.force_login(get_user_model().objects.create_user('other-user', 'other-user@example.com', 'Other User'))
+        response = client.post(self.endpoint, dict(params, identifier='elsewhere'))
+        self.assertEqual(response.status_code, 204)
+    
     def test_materialize(self):
         self.assertFalse(self.upload.file)
         
@@ -222,6 +548,18 @@ class CommonTestsMixin(object):
         self.assertEqual(secret.value, 'super-secret')
 
 
+class GetIndexRangesTests(SimpleTestCase):
+    def test_get_index_ranges(self):
+        for indices, expected in (
+            ([], []),
+            ([1], [[1, 1]]),
+            ([1, 2, 3], [[1, 3]]),
+            ([1, 2, 4, 6, 7], [[1, 2], [4, 4], [6, 7]]),
+        ):
+            with self.subTest(indices=indices):
+                self.assertEqual(get_index_ranges(indices), expected)
+
+
 class UserUploadViewTests(CommonTestsMixin, BaseUploadViewTests):
     def setUp(self):
         super().setUp()
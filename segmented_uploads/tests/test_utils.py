@@ -0,0 +1,48 @@
+import threading
+from unittest.mock import Mock
+
+from django.test import SimpleTestCase, override_settings
+from redis.exceptions import LockError
+
+from ..utils import LockHeartbeat, hold_lock
+
+
+class LockHeartbeatTests(SimpleTestCase):
+    def test_heartbeat_renews_lock(self):
+        renewed = threading.Event()
+        lock = Mock()
+        lock.reacquire.side_effect = lambda: lock.reacquire.call_count < 3 or renewed.set()
+        with LockHeartbeat(lock, 0.01) as heartbeat:
+            self.assertTrue(renewed.wait(5))
+            heartbeat.check()
+        self.assertFalse(heartbeat.thread.is_alive())
+        self.assertFalse(heartbeat.aborted.is_set())
+    
+    def test_heartbeat_aborts_when_renewal_fails(self):
+        lock = Mock()
+        lock.name = 'some-lock'
+        lock.reacquire.side_effect = LockError('lost')
+        with LockHeartbeat(lock, 0.01) as heartbeat:
+            self.assertTrue(heartbeat.aborted.wait(5))
+            with self.assertRaisesMessage(LockError, 'Lock some-lock was lost'):
+                heartbeat.check()
+        self.assertEqual(lock.reacquire.call_count, 1)
+    
+    def test_heartbeat_is_not_renewed_after_exit(self):
+        lock = Mock()
+        with LockHeartbeat(lock, 60):
+            pass
+        lock.reacquire.assert_not_called()
+
+
+class HoldLockTests(SimpleTestCase):
+    @override_settings(UPLOADS_LOCK_TIMEOUT=3)
+    def test_hold_lock(self):
+        with hold_lock('segmented_uploads;tests;hold_lock') as heartbeat:
+            self.assertEqual(heartbeat.interval, 1)
+            with self.assertRaises(LockError):
+                with hold_lock('segmented_uploads;tests;hold_lock'):
+                    pass
+        self.assertFalse(heartbeat.thread.is_alive())
+        with hold_lock('segmented_uploads;tests;hold_lock'):
+            pass
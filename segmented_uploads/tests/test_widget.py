@@ -3,7 +3,7 @@ from unittest.mock import patch
 from django.core.files.base import ContentFile
 from django.db import transaction
 from django.forms import Field
-from django.test import TestCase, TransactionTestCase
+from django.test import TestCase, TransactionTestCase, override_settings
 
 from segmented_uploads.widgets import SegmentedFileInput
 
@@ -75,3 +75,19 @@ class WidgetValueFromDataDictTransactionTestCase(WidgetValueFromDataDictMixin, T
         self.assertTrue(self.upload.file.storage.exists(self.upload.file.name))
         self.assertEqual(self.expected_upload_file_name, self.upload.file.name)
         self.assertTrue(self.upload.lingering)
+    
+    @override_settings(UPLOADS_MATERIALIZE_LAZILY=True)
+    def test_cleanup_after_lazy_file_is_closed(self):
+        upload = Upload.objects.create(token='lazy-token', session='some-session')
+        segment = UploadSegment.objects.create(index=1, file=ContentFile(b'qux', name='qux.txt'), upload=upload)
+        secret = UploadSecret.objects.create(upload=upload)
+        upload.materialize()
+        self.assertTrue(upload.lazy)
+        widget = SegmentedFileInput()
+        value = widget.value_from_datadict({self.name: secret.value}, self.files, self.name)
+        self.assertTrue(Upload.objects.filter(pk=upload.pk).exists())
+        self.assertTrue(segment.file.storage.exists(segment.file.name))
+        self.assertEqual(value.read(), b'qux')
+        value.close()
+        self.assertFalse(Upload.objects.filter(pk=upload.pk).exists())
+        self.assertFalse(segment.file.storage.exists(segment.file.name))
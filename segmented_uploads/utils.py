@@ -1,5 +1,53 @@
+import logging
+import threading
+from contextlib import contextmanager
+
 from django.conf import settings
-from django.core.cache import caches
+from django.db import connections
+
+from .locks import LockError, get_lock
+
+logger = logging.getLogger(__name__)
+
+
+class LockHeartbeat(object):
+    def __init__(self, lock, interval):
+        self.lock = lock
+        self.interval = interval
+        self.aborted = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+    
+    def run(self):
+        try:
+            while not self.stopped.wait(self.interval):
+                try:
+                    self.lock.reacquire()
+                except Exception:
+                    logger.exception('Unable to renew lock %s', self.lock.name)
+                    self.aborted.set()
+                    return
+        finally:
+            # renewals may have opened database connections for this thread
+            connections.close_all()
+    
+    def check(self):
+        if self.aborted.is_set():
+            raise LockError('Lock %s was lost' % self.lock.name)
+    
+    def __enter__(self):
+        self.thread.start()
+        return self
+    
+    def __exit__(self, *args):
+        self.stopped.set()
+        self.thread.join()
 
 
-cache_redis = caches[getattr(settings, 'UPLOADS_CACHE_LOCK_REDIS_NAME', 'default')]
+@contextmanager
+def hold_lock(name, timeout=None):
+    if timeout is None:
+        timeout = getattr(settings, 'UPLOADS_LOCK_TIMEOUT', 10)
+    with get_lock(name, timeout) as lock:
+        with LockHeartbeat(lock, timeout / 3) as heartbeat:
+            yield heartbeat
@@ -1,13 +1,20 @@
 import logging
 from django.conf import settings
 from django.core.exceptions import PermissionDenied, SuspiciousOperation, ValidationError, NON_FIELD_ERRORS
+from django.core.files.base import ContentFile
 from django.db import models
 from django.http import HttpResponse, HttpResponseRedirect, Http404, JsonResponse
 from django.shortcuts import get_object_or_404
+from django.utils.decorators import method_decorator
+from django.middleware.csrf import CsrfViewMiddleware
+from django.utils.module_loading import import_string
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
 from django.views.generic.base import View
-from redis.exceptions import LockError as RedisLockError
 
-from .models import Upload, UploadSecret, UploadSegment, hasher_map
+from .handlers import SegmentUploadHandler, receive_raw_segment
+from .locks import LockError
+from .models import Upload, UploadSecret, UploadSegment, get_supported_algorithms, is_supported_algorithm
+from .utils import hold_lock
 
 logger = logging.getLogger(__name__)
 
@@ -48,8 +55,32 @@ def get_upload_lookups(request):
     return kwargs
 
 
+def uses_csrf_middleware():
+    return any(issubclass(import_string(path), CsrfViewMiddleware) for path in settings.MIDDLEWARE)
+
+
+def get_index_ranges(indices):
+    ranges = []
+    for index in indices:
+        if ranges and ranges[-1][1] + 1 == index:
+            ranges[-1][1] = index
+        else:
+            ranges.append([index, index])
+    return ranges
+
+
 class UploadView(View):
+    @method_decorator(csrf_exempt)
     def dispatch(self, request, *args, **kwargs):
+        # upload handlers can only be replaced before the request body is parsed,
+        # which CsrfViewMiddleware would do, so the view is exempt from it and
+        # checks csrf afterwards instead wherever the middleware is installed
+        request.upload_handlers = [SegmentUploadHandler(request)]
+        if uses_csrf_middleware():
+            return csrf_protect(self.dispatch_protected)(request, *args, **kwargs)
+        return self.dispatch_protected(request, *args, **kwargs)
+    
+    def dispatch_protected(self, request, *args, **kwargs):
         try:
             self.validate_user(request=request)
             if request.method != 'PUT':
@@ -89,18 +120,22 @@ class UploadView(View):
             "validation": {
                 "segment_limit": SEGMENT_LIMIT,
                 "segment_allowable_size": SEGMENT_ALLOWABLE_SIZE,
+                "algorithms": get_supported_algorithms(),
+                "deduplicate": Upload.deduplication_enabled(),
             }
         })
     
     def get(self, request):
+        if "manifest" in request.GET:
+            return self.get_manifest(request)
         index = request.GET["index"]
         algorithm = request.GET.get("algorithm", "")
         digest = request.GET.get("digest", "")
         try:
             upload = get_object_or_404(Upload, **get_upload_lookups(request))
-            if not upload.file:
+            if not upload.is_materialized:
                 segment = get_object_or_404(UploadSegment, index=index, upload=upload)
-                if not segment.file or not segment.file.storage.exists(segment.file.name):
+                if not segment.exists():
                     raise Http404
                 elif digest:
                     try:
@@ -111,6 +146,28 @@ class UploadView(View):
             return HttpResponse('', status=204)
         return HttpResponse('')
     
+    def get_manifest(self, request):
+        # answered from the recorded segments alone, storage is only checked when materializing
+        indices = []
+        digests = {}
+        try:
+            upload = get_object_or_404(Upload, **get_upload_lookups(request))
+        except Http404:
+            materialized = False
+        else:
+            materialized = upload.is_materialized
+            # attempts that never stored anything have neither a file nor an offset
+            segments = upload.segments.exclude(file='', offset__isnull=True)
+            for segment in segments:
+                indices.append(segment.index)
+                if segment.digest:
+                    digests[segment.index] = segment.get_digests()
+        return JsonResponse({
+            "materialized": materialized,
+            "received": get_index_ranges(indices),
+            "digests": digests,
+        })
+    
     def validate_user(self, request):
         user = get_user_or_none(request)
         if user is None and getattr(settings, 'UPLOADS_REQUIRE_AUTHENTICATION', True):
@@ -132,6 +189,16 @@ class UploadView(View):
         if SEGMENT_LIMIT < count:
             raise SuspiciousOperation("Upload has too many segments!")
     
+    def validate_segment_index(self, index):
+        # indices are unique per upload, so bounding them bounds the segment
+        # count without having to count the segments
+        try:
+            index = int(index)
+        except ValueError:
+            raise ValidationError("Invalid segment index!", code='invalid')
+        if not 0 < index <= SEGMENT_LIMIT:
+            raise SuspiciousOperation("Upload has too many segments!")
+    
     def validate_segment_size(self, request=None, size=None):
         size = get_param(request, "segment_size", coerce=int, required=False) or 0 if size is None else size
         if SEGMENT_ALLOWABLE_SIZE < size:
@@ -139,11 +206,13 @@ class UploadView(View):
     
     def validate_total_size(self, request=None, size=None):
         size = get_param(request, "total_size", coerce=int, required=False) or 0 if size is None else size
+        if size < 0:
+            raise ValidationError("Invalid file size!", code='invalid')
         if SEGMENT_ALLOWABLE_SIZE * SEGMENT_LIMIT < size:
             raise SuspiciousOperation("File is too large!")
     
     def validate_algorithm(self, algorithm):
-        if algorithm and algorithm not in hasher_map.keys():
+        if algorithm and not is_supported_algorithm(algorithm):
             raise SuspiciousOperation("Unsupported algorithm!")
     
     def put(self, request):
@@ -168,49 +237,160 @@ class UploadView(View):
         request.session.delete()
         return HttpResponse('', status=204)
     
+    def get_uploaded_file(self, request):
+        if request.method == 'PATCH':
+            self.validate_segment_size(size=int(request.META.get('CONTENT_LENGTH') or 0))
+            # request.close() closes it along with any other uploaded file
+            request.FILES.appendlist("file", receive_raw_segment(request))
+        return request.FILES["file"]
+    
+    def get_reused_file(self, request, upload, algorithm, digest):
+        if not algorithm or not digest:
+            raise SuspiciousOperation("Reusing segments requires a digest and algorithm!")
+        size = get_param(request, "segment_size", coerce=int)
+        candidates = UploadSegment.held_by(
+            user=upload.user_id,
+            session=upload.session,
+            digest_algorithm=algorithm,
+            digest=digest,
+            size=size,
+        ).select_related('upload')
+        for segment in candidates[:3]:
+            try:
+                data = segment.read()
+            except FileNotFoundError:
+                continue
+            if len(data) == size:
+                uploaded_file = ContentFile(data, name='segment')
+                # the stored digest was computed when the segment was received
+                uploaded_file.digests = segment.get_digests()
+                return uploaded_file
+        # the segments of materialized uploads are gone, but their bytes can be
+        # copied out of the file
+        sources = Upload.held_by(
+            user=upload.user_id,
+            session=upload.session,
+            segment_digests__contains=digest,
+        ).exclude(file='')
+        for source in sources[:3]:
+            try:
+                found = source.read_segment(algorithm, digest, size)
+            except FileNotFoundError:
+                continue
+            if found is not None and len(found[0]) == size:
+                data, digests = found
+                uploaded_file = ContentFile(data, name='segment')
+                uploaded_file.digests = digests
+                return uploaded_file
+        return None
+    
+    def patch(self, request):
+        # segments sent as the raw request body skip multipart parsing entirely
+        get_param(request, "index")
+        return self.post(request)
+    
+    def post_instant(self, request, filename, algorithm, digest):
+        # no content tells the client to send the segments instead
+        if not algorithm or not digest:
+            raise SuspiciousOperation("Instant uploads require a digest and algorithm!")
+        if not Upload.deduplication_enabled():
+            # there are no shared files to finish from
+            return HttpResponse('', status=204)
+        size = get_param(request, "total_size", coerce=int)
+        
+        upload, created = Upload.objects.get_or_create(
+            defaults={"filename": filename},
+            **get_upload_lookups(request)
+        )
+        if created:
+            upload.full_clean(validate_unique=False)
+        
+        if not upload.is_materialized:
+            try:
+                shared = upload.materialize_from_copy(algorithm, digest, size)
+            except LockError:
+                raise StateConflictError('upload is being materialized')
+            if not shared:
+                return HttpResponse('', status=204)
+        
+        self.validate_digest(digest, upload.digest)
+        secret = UploadSecret.objects.create(upload=upload)
+        return HttpResponse(secret.value)
+    
     def post(self, request):
-        index = request.POST.get("index", "")
-        filename = request.POST.get("filename", "")
-        algorithm = request.POST.get("algorithm", "")
-        digest = request.POST.get("digest", "")
+        index = get_param(request, "index", required=False)
+        filename = get_param(request, "filename", required=False)
+        algorithm = get_param(request, "algorithm", required=False)
+        digest = get_param(request, "digest", required=False)
         
         self.validate_algorithm(algorithm)
+        
+        if get_param(request, "instant", required=False):
+            return self.post_instant(request, filename, algorithm, digest)
 
         upload, created = Upload.objects.get_or_create(
             defaults={"filename": filename},
             **get_upload_lookups(request)
         )
-        upload.full_clean()
+        if created:
+            # existing uploads were validated when they were created and the
+            # database enforces uniqueness, so only new ones need cleaning
+            upload.full_clean(validate_unique=False)
     
         if index:
             
-            if upload.file:
+            if upload.is_materialized:
                 raise StateConflictError('already materialized')
             
-            self.validate_segment_count(count=upload.segments.count())
+            self.validate_segment_index(index)
             
-            uploaded_file = request.FILES["file"]
+            if get_param(request, "reuse", required=False):
+                uploaded_file = self.get_reused_file(request, upload, algorithm, digest)
+                if uploaded_file is None:
+                    return HttpResponse('', status=204)
+            else:
+                uploaded_file = self.get_uploaded_file(request)
             self.validate_segment_size(size=uploaded_file.size)
     
-            segment = UploadSegment.objects.get_or_create(upload=upload, index=index)[0]
-            segment.attempt_count += 1
+            segment = UploadSegment.record_attempt(upload, index)
             
             if getattr(settings, 'UPLOADS_SEGMENT_MAX_ATTEMPT_COUNT', 3) < segment.attempt_count:
                 raise SuspiciousOperation("Segment has been uploaded too many times!")
             
             replace_file = True
-            if segment.file:
+            if segment.file or segment.is_assembled:
                 if digest:
                     try:
                         self.validate_digest(digest, segment.get_digest, algorithm=algorithm)
                     except ValidationError:
-                        segment.file.delete(save=False)
+                        if segment.file:
+                            segment.file.delete(save=False)
+                        segment.digest_algorithm = segment.digest = segment.digests = ''
                     except FileNotFoundError:
                         logger.warning('Encountered situation where segment %s file did not exist for upload %s when it should. Proceeding with file replacement.', segment.pk, upload.pk)
                     else:
                         replace_file = False
     
-            if replace_file:
+            if replace_file and segment.is_assembled:
+                try:
+                    with hold_lock(upload.materialize_lock_key):
+                        segment.overwrite_assembled(uploaded_file, algorithm=algorithm)
+                except LockError:
+                    raise StateConflictError('upload is being assembled')
+                segment.save(update_fields=['digest_algorithm', 'digest', 'digests'])
+                if digest:
+                    self.validate_digest(digest, segment.digest)
+            elif replace_file and upload.assembles_by_offset():
+                total_size = get_param(request, "total_size", coerce=int)
+                chunk_size = get_param(request, "chunk_size", coerce=int, required=False) or SEGMENT_ALLOWABLE_SIZE
+                if total_size <= 0 or chunk_size < 0:
+                    raise ValidationError("Invalid file size!", code='invalid')
+                self.validate_segment_size(size=chunk_size)
+                upload.preallocate(total_size, chunk_size)
+                segment.write_at_offset(uploaded_file, algorithm=algorithm)
+                if digest:
+                    self.validate_digest(digest, segment.digest)
+            elif replace_file:
                 name = '{upload}-{segment}-{index}-{attempt}-{filename}'.format(
                     upload=upload.pk,
                     segment=segment.pk,
@@ -218,26 +398,35 @@ class UploadView(View):
                     attempt=segment.attempt_count,
                     filename=filename,
                 )
+                segment.hash_uploaded_file(uploaded_file, algorithm=algorithm)
+                segment.size = uploaded_file.size
                 segment.file.save(name, uploaded_file, save=False)
                 try:
-                    segment.full_clean()
+                    segment.full_clean(exclude=['upload'], validate_unique=False)
                 except ValidationError:
                     segment.file.delete(save=False)
                     raise
-                segment.save()
+                segment.save(update_fields=['file', 'size', 'digest_algorithm', 'digest', 'digests'])
                 
                 if digest:
-                    segment.refresh_from_db(fields=['file'])
-                    self.validate_digest(digest, segment.get_digest, algorithm=algorithm)
+                    self.validate_digest(digest, segment.digest)
+            
+            if upload.assembles_incrementally():
+                try:
+                    upload.assemble_incrementally()
+                except LockError:
+                    # whoever holds the lock is assembling and will pick this
+                    # segment up, otherwise materialization will
+                    pass
         else:
             
             if created:
                 raise SuspiciousOperation("Upload cannot be created and finalized in same request!")
             
-            if not upload.file:
+            if not upload.is_materialized:
                 try:
                     result = upload.materialize(algorithm=algorithm)
-                except RedisLockError:
+                except LockError:
                     logger.exception('Unable to obtain lock for materialization of upload %s', upload.pk)
                 else:
                     if result:
@@ -245,7 +434,7 @@ class UploadView(View):
                             if url:
                                 return HttpResponse(url, status=300)
             
-            if upload.file:
+            if upload.is_materialized:
                 try:
                     self.validate_digest(digest, upload.digest)
                 except ValidationError:
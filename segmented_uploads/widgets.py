@@ -19,7 +19,7 @@ class SegmentedFileInput(FileInput):
                 raise SuspiciousOperation('secret did not exist')
             else:
                 upload = secret.upload
-                files[name] = upload.uploaded_file
+                uploaded_file = files[name] = upload.uploaded_file
                 def cleanup():
                     secret.delete()
                     #
@@ -47,7 +47,17 @@ class SegmentedFileInput(FileInput):
                             logger.exception('Unable to delete upload %s. It will linger along with file "%s" until purged.', upload.pk, upload.file.name)
                             upload.lingering = True
                             upload.save()
-                transaction.on_commit(cleanup)
+                if upload.lazy:
+                    # the segments are read in place, so they are only deleted
+                    # once the request is done with the file and closes it
+                    def defer_cleanup():
+                        if uploaded_file.closed:
+                            cleanup()
+                        else:
+                            uploaded_file.close_callbacks.append(cleanup)
+                    transaction.on_commit(defer_cleanup)
+                else:
+                    transaction.on_commit(cleanup)
         return super().value_from_datadict(data, files, name)
 
     def value_omitted_from_data(self, data, files, name):